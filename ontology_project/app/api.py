@@ -0,0 +1,267 @@
+import asyncio
+import hmac
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Literal, Optional
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Header, HTTPException, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from ontology_index import DEPTH_MODES, DIRECTIONS
+from ontology_metrics import StageTimings, render_metric, render_metrics
+from ontology_service import (ADMIN_TOKEN, CLOSURE_DEPTH, DEFAULT_DIR_CSV, MAX_PENDING_QUERIES, QUERY_THREADS,
+                              QUERY_TIMEOUT, RELOAD_INTERVAL, SERVER_TIMING, OntologyWatcher, apply_ontology_diff,
+                              cached_query_result, compute_query_result, get_loaded_ontology_index, get_ontology_index,
+                              iter_batch_results, query_ontology_index, resolve_label, result_cache, search_ontology,
+                              served_dir_csv, start_reload, unresolved_label_message)
+
+# Cached results with at most this many entries are serialized in the event loop, the larger ones in the executor
+INLINE_RESULT_SIZE = 1000
+# Number of lines of a batch computed at a time in the executor
+BATCH_CHUNK_LINES = 64
+
+# Threads computing the queries, so that the traversals never block the event loop
+executor = None
+# Number of queries computed or queued in the executor, capped by MAX_PENDING_QUERIES
+pending_queries = 0
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global executor
+    executor = ThreadPoolExecutor(QUERY_THREADS, thread_name_prefix='ontology-query')
+    get_ontology_index(served_dir_csv(DEFAULT_DIR_CSV), CLOSURE_DEPTH)
+    watcher = None
+    if RELOAD_INTERVAL > 0:
+        watcher = OntologyWatcher(RELOAD_INTERVAL, CLOSURE_DEPTH)
+        watcher.start()
+    yield
+    if watcher is not None:
+        watcher.stop()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def check_pending_queries():
+    # Rejects the query rather than queuing it without bound when the server is overloaded, so that the latency of the
+    # accepted queries stays bounded
+    if pending_queries >= MAX_PENDING_QUERIES:
+        raise HTTPException(status_code=503, detail='Too many queries are being processed, please retry later.',
+                            headers={'Retry-After': '1'})
+
+
+def reserve_query():
+    global pending_queries
+    check_pending_queries()
+    pending_queries += 1
+
+
+def release_query(*_):
+    global pending_queries
+    pending_queries -= 1
+
+
+async def run_query(function, *args):
+    """
+    Runs a function in the executor of the queries, within the cap on pending queries and the query timeout.
+
+    The slot of the query is only released when the function returns, even if the query timed out or its client left,
+    as the thread computing it cannot be interrupted.
+
+    Raises:
+        HTTPException: 503 if too many queries are pending, 504 if the function does not return within QUERY_TIMEOUT.
+    """
+    reserve_query()
+    future = asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    future.add_done_callback(release_query)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), QUERY_TIMEOUT or None)
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail=f'The query did not complete within {QUERY_TIMEOUT} seconds.')
+
+
+def served_path(dir_csv):
+    # Only the configured CSV files are loaded, by their canonical path (see `served_dir_csv`)
+    path = served_dir_csv(dir_csv)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"The ontology '{dir_csv}' is not served by this API.")
+    return path
+
+
+async def ontology_index(dir_csv):
+    # The first query on a CSV file loads it in the executor, as any other query
+    index = get_loaded_ontology_index(dir_csv, CLOSURE_DEPTH)
+    if index is None:
+        index = await run_query(get_ontology_index, dir_csv, CLOSURE_DEPTH)
+    return index
+
+
+def version_headers(index):
+    # Tells the callers which version of the ontology answered their query
+    return {'ETag': f'"{index.version}"', 'X-Ontology-Version': str(index.version)}
+
+
+app = FastAPI(lifespan=lifespan)
+class QueryRequest(BaseModel):
+    dir_csv: str = DEFAULT_DIR_CSV
+    # dir_csv: str = 'data/onto_x.csv'
+    label: str
+    n: int = 9999
+    depth: Literal[DEPTH_MODES] = 'shortest'
+    direction: Literal[DIRECTIONS] = 'ancestors'
+    # Include every entity of the ontology (0 for the unrelated ones) instead of the relatives of the label only
+    dense: bool = False
+
+def render_query_result(request, index, timings, result=None):
+    if result is not None:
+        content = result
+    else:
+        # The label may also be a Class ID, or a label with another case (see `resolve_label`)
+        label = resolve_label(index, request.label, timings)
+        if label is None:
+            content = unresolved_label_message(index, request.label, timings)
+        elif label == request.label:
+            # Its result was already looked up in the cache
+            content = compute_query_result(request.dir_csv, index, label, request.n, request.depth,
+                                           request.direction, request.dense, timings)
+        else:
+            content = query_ontology_index(request.dir_csv, index, label, request.n, request.depth, request.direction,
+                                           request.dense, timings)
+    with timings.stage('serialize'):
+        response = JSONResponse(content, headers=version_headers(index))
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+@app.post('/query-ontology/')
+async def query_ontology(request: QueryRequest):
+    request.dir_csv = served_path(request.dir_csv)
+    timings = StageTimings()
+    index = await ontology_index(request.dir_csv)
+    # A small cached result is answered without going through the executor
+    result = cached_query_result(request.dir_csv, index, request.label, request.n, request.depth, request.direction,
+                                 request.dense, timings)
+    if result is not None and len(result) <= INLINE_RESULT_SIZE:
+        return render_query_result(request, index, timings, result)
+    return await run_query(render_query_result, request, index, timings, result)
+
+class BatchQueryRequest(BaseModel):
+    dir_csv: str = DEFAULT_DIR_CSV
+    labels: list[str]
+    n: int = 9999
+    depth: Literal[DEPTH_MODES] = 'shortest'
+    direction: Literal[DIRECTIONS] = 'ancestors'
+
+def read_lines(lines):
+    return ''.join(islice(lines, BATCH_CHUNK_LINES))
+
+async def iter_in_executor(lines):
+    # The batch holds a slot until it is fully streamed, its lines being computed by chunks in the executor. The slot
+    # is taken here rather than in the endpoint, so that it is released even if the response is never streamed. The
+    # query timeout does not apply, as the response has already started.
+    global pending_queries
+    loop = asyncio.get_running_loop()
+    pending_queries += 1
+    try:
+        while chunk := await loop.run_in_executor(executor, read_lines, lines):
+            yield chunk
+    finally:
+        release_query()
+
+@app.post('/query-ontology/batch')
+async def query_ontology_batch(request: BatchQueryRequest):
+    request.dir_csv = served_path(request.dir_csv)
+    index = await ontology_index(request.dir_csv)
+    check_pending_queries()
+    lines = iter_batch_results(index, request.labels, request.n, request.depth, request.direction)
+    return StreamingResponse(iter_in_executor(lines), media_type='application/x-ndjson',
+                             headers=version_headers(index))
+
+@app.get('/search')
+async def search(q: str, limit: int = 10, fuzzy: bool = False, dir_csv: str = DEFAULT_DIR_CSV):
+    # Autocompletion and spelling suggestions for the labels, e.g. /search?q=dermat
+    index = await ontology_index(served_path(dir_csv))
+    timings = StageTimings()
+    content = await run_query(search_ontology, index, q, limit, fuzzy, timings)
+    response = JSONResponse(content, headers=version_headers(index))
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+@app.get('/admin/cache')
+def result_cache_stats():
+    return result_cache.stats()
+
+@app.get('/metrics')
+def metrics():
+    # Histograms of the duration of the stages of the loads and queries, then the state of the cache and executor
+    stats = result_cache.stats()
+    content = render_metrics(
+        render_metric('ontology_result_cache_hits_total', 'Number of queries answered by the result cache.', 'counter',
+                      stats['hits']),
+        render_metric('ontology_result_cache_misses_total', 'Number of queries not answered by the result cache.',
+                      'counter', stats['misses']),
+        render_metric('ontology_result_cache_evictions_total', 'Number of results evicted from the result cache.',
+                      'counter', stats['evictions']),
+        render_metric('ontology_result_cache_bytes', 'Estimated size of the cached results.', 'gauge', stats['bytes']),
+        render_metric('ontology_pending_queries', 'Number of queries computed or queued in the executor.', 'gauge',
+                      pending_queries))
+    return PlainTextResponse(content, media_type='text/plain; version=0.0.4')
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    # The admin endpoints change the ontology served to every client: they are disabled unless ONTOLOGY_ADMIN_TOKEN
+    # is set, and then only answer the callers sending it
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail='The admin endpoints are disabled, set ONTOLOGY_ADMIN_TOKEN.')
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail='Invalid or missing admin token.',
+                            headers={'WWW-Authenticate': 'Bearer'})
+
+class ReloadRequest(BaseModel):
+    dir_csv: str = DEFAULT_DIR_CSV
+
+@app.post('/admin/reload', status_code=202, dependencies=[Depends(require_admin)])
+def reload_ontology(request: ReloadRequest, response: Response):
+    path = served_path(request.dir_csv)
+    # Only an ontology already loaded is reloaded, a new one is loaded by its first query
+    index = get_loaded_ontology_index(path)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"The ontology '{request.dir_csv}' is not loaded.")
+    # The index is rebuilt in a background thread, the current version keeps answering the queries until the swap
+    response.headers.update(version_headers(index))
+    return {'reloading': start_reload(path, CLOSURE_DEPTH), 'version': index.version}
+
+
+class DiffRow(BaseModel):
+    # A row of the csv file, with its column names as keys
+    class_id: str = Field(alias='Class ID', min_length=1)
+    preferred_label: str = Field(alias='Preferred Label', min_length=1)
+    parents: Optional[str] = Field(alias='Parents')
+
+class DiffRequest(BaseModel):
+    dir_csv: str = DEFAULT_DIR_CSV
+    added: list[DiffRow] = []
+    removed: list[str] = []
+    changed: list[DiffRow] = []
+
+@app.post('/admin/diff', dependencies=[Depends(require_admin)])
+def apply_diff_to_ontology(request: DiffRequest, response: Response):
+    path = served_path(request.dir_csv)
+    if get_loaded_ontology_index(path) is None:
+        raise HTTPException(status_code=404, detail=f"The ontology '{request.dir_csv}' is not loaded.")
+    request.dir_csv = path
+    started = time.perf_counter()
+    try:
+        index = apply_ontology_diff(request.dir_csv, [row.model_dump(by_alias=True) for row in request.added],
+                                    request.removed, [row.model_dump(by_alias=True) for row in request.changed])
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    if index is None:
+        raise HTTPException(status_code=409, detail='The ontology is being reloaded, please retry once it is done.',
+                            headers={'Retry-After': '1'})
+    response.headers.update(version_headers(index))
+    return {'version': index.version, 'seconds': time.perf_counter() - started}
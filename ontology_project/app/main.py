@@ -1,60 +1,112 @@
 import argparse
-import pandas as pd
 import json
-from fastapi import FastAPI
-from pydantic import BaseModel
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from ontology_helper import *
-
-app = FastAPI()
-class QueryRequest(BaseModel):
-    dir_csv: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'onto_x.csv')
-    # dir_csv: str = 'data/onto_x.csv'
-    label: str
-    n: int = 9999
-
-@app.post('/query-ontology/')
-def query_ontology(request: QueryRequest):
-    df = pd.read_csv(request.dir_csv)
-    df_formatted = preprocess_dataframe(df)
-    empty_dict = initialize_empty_dictionary_from_df(df_formatted)
-    label = request.label
-    if label in list(df_formatted['Preferred Label'].unique()):
-        onto_dict = get_ontology(label, df_formatted)
-        final_dict = sort_dictionary(fill_dictionary_with_ontology_results(empty_dict, onto_dict))
-
-        n = request.n
-        first_elements = {k: v for i, (k, v) in enumerate(final_dict.items()) if i < n}
-        return first_elements
-    else:
-        return f"The entity '{label}' is not present in the CSV. Please, check the spelling of the label."
+from ontology_index import DEPTH_MODES, DIRECTIONS
+from ontology_metrics import StageTimings
+from ontology_service import (DEFAULT_DIR_CSV, get_ontology_index, iter_batch_results, load_csv_index,
+                              query_ontology_index, resolve_label, search_ontology, unresolved_label_message)
+from ontology_snapshot import snapshot_path, write_snapshot
+
+
+def __getattr__(name):
+    # The FastAPI application is only imported when it is asked for (`uvicorn app.main:app`), so that the CLI does not
+    # pay for the import of the web stack.
+    if name == 'app':
+        from api import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def main(args):
-    df = pd.read_csv(args.dir_csv)
-    df_formatted = preprocess_dataframe(df)
-    empty_dict = initialize_empty_dictionary_from_df(df_formatted)
-    label = args.label
-    if label in list(df_formatted['Preferred Label'].unique()):
-        onto_dict = get_ontology(label, df_formatted)
-        final_dict = sort_dictionary(fill_dictionary_with_ontology_results(empty_dict, onto_dict))
-
-        n = args.n
-        first_elements = {k: v for i, (k, v) in enumerate(final_dict.items()) if i < n}
-        print(json.dumps(first_elements, indent=0))
+    timings = StageTimings()
+    try:
+        run(args, timings)
+    finally:
+        if args.profile:
+            print(timings.report(), file=sys.stderr)
+
+
+def run(args, timings):
+    if args.compile:
+        index = load_csv_index(args.dir_csv, timings)
+        if args.closure is not None:
+            with timings.stage('closure'):
+                summary = index.precompute_closure(args.closure).summary()
+            print(summary, file=sys.stderr)
+        with timings.stage('snapshot_write'):
+            write_snapshot(index, snapshot_path(args.dir_csv))
+        print(f'Snapshot written to {snapshot_path(args.dir_csv)}', file=sys.stderr)
+        return
+
+    index = get_ontology_index(args.dir_csv, args.closure, timings)
+    if args.search is not None:
+        print(json.dumps(search_ontology(index, args.search, args.limit, args.suggest, timings), indent=1))
+        return
+
+    if args.labels_file is not None:
+        labels_file = sys.stdin if args.labels_file == '-' else open(args.labels_file)
+        with labels_file:
+            labels = (line.strip() for line in labels_file)
+            for line in iter_batch_results(index, (label for label in labels if label), args.n, args.depth,
+                                           args.direction, timings):
+                sys.stdout.write(line)
+        return
+
+    # The label may also be a Class ID, or a label with another case (see `resolve_label`)
+    label = resolve_label(index, args.label, timings)
+    if label is not None:
+        first_elements = query_ontology_index(args.dir_csv, index, label, args.n, args.depth, args.direction,
+                                              args.dense, timings)
+        with timings.stage('serialize'):
+            output = json.dumps(first_elements, indent=0)
+        print(output)
     else:
-        print(f"The entity '{label}' is not present in the CSV. Please, check the spelling of the label.")
+        print(unresolved_label_message(index, args.label, timings))
+        # The n-gram index of the suggestions takes seconds to build on a large ontology, hence the option
+        suggestions = []
+        if args.suggest:
+            suggestions = search_ontology(index, args.label, fuzzy=True, timings=timings)['suggestions']
+        if suggestions:
+            names = ', '.join(repr(entity['label']) for entity in suggestions[:5])
+            print(f'Did you mean: {names}?', file=sys.stderr)
 
 if __name__ == '__main__':
-    dir_csv = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'onto_x.csv')
     parser = argparse.ArgumentParser(description='Ontology API')
-    parser.add_argument('--dir_csv', default=dir_csv, type=str, help='Path to the csv file containing the ontology')
-    parser.add_argument('--label', type=str, required=True, help='Name of the entity used for the query')
-    parser.add_argument('--n', default=9999, type=int, help='Number of entities shown after a query. Set by default at 10')
+    parser.add_argument('--dir_csv', default=DEFAULT_DIR_CSV, type=str,
+                        help='Path to the csv file containing the ontology')
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument('--label', type=str,
+                       help='Name of the entity used for the query (its Class ID, or its name with another case, '
+                            'also work)')
+    query.add_argument('--search', type=str,
+                       help='Print as JSON the entities whose name matches, starts like or resembles this text')
+    query.add_argument('--compile', action='store_true',
+                       help='Compile the csv file into a binary snapshot, loaded instead of it while it is newer')
+    query.add_argument('--labels_file', type=str,
+                       help='Path to a file with one entity name per line (- for stdin), queried as a batch whose '
+                            'results are written as NDJSON')
+    parser.add_argument('--n', default=9999, type=int,
+                        help='Maximum number of entities shown after a query, defaults to 9999')
+    parser.add_argument('--depth', default='shortest', choices=DEPTH_MODES,
+                        help='Length of the path used as the depth of an ancestor reached by several paths')
+    parser.add_argument('--direction', default='ancestors', choices=DIRECTIONS,
+                        help='Relatives returned by the query: its ancestors (positive levels), its descendants '
+                             '(negative levels) or both')
+    parser.add_argument('--dense', action='store_true',
+                        help='Show every entity of the ontology (0 for the unrelated ones), not only the relatives')
+    parser.add_argument('--closure', default=None, choices=DEPTH_MODES,
+                        help='Precompute the ancestor closure for this depth mode, and report its size and build time')
+    parser.add_argument('--limit', default=10, type=int,
+                        help='Maximum number of completions and of suggestions printed by --search')
+    parser.add_argument('--suggest', action='store_true',
+                        help='Suggest similar names for an unknown --label, and always search them for --search. '
+                             'Builds an index of the names first, which takes seconds on a large ontology')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the duration of each stage (load, traversal, selection, serialization) on stderr')
 
     args = parser.parse_args()
+    if not (args.label or args.labels_file or args.compile or args.search):
+        parser.error('one of the arguments --label --compile --labels_file --search is required')
     main(args)
-
-
-
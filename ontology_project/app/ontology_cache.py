@@ -0,0 +1,119 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+def result_size(result):
+    """
+    Estimates the memory held by a cached result, in bytes.
+
+    The labels are counted with the dictionary and its values: an index loaded from a snapshot decodes a new string
+    each time a label is accessed, so the labels of a result are owned by it rather than shared with the index.
+
+    Args:
+        result (dict): A query result, mapping labels to levels.
+
+    Returns:
+        int: The estimated size of the result.
+    """
+    return sys.getsizeof(result) + sum(sys.getsizeof(key) + (sys.getsizeof(value) if not -5 <= value <= 256 else 0)
+                                       for key, value in result.items())
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of query results, shared by the threads serving the queries.
+
+    The results are stored as they are returned (sorted and sliced), so that a hit skips both the traversal and the
+    sort. When the estimated size of the cached results exceeds `max_bytes`, the least recently used ones are evicted.
+    The keys are expected to contain the version of the index, so that a result computed on an older version of the
+    ontology is never returned.
+
+    Args:
+        max_bytes (int): Memory budget of the cache, in bytes. 0 disables the cache.
+
+    Attributes:
+        hits (int): Number of lookups answered by the cache.
+        misses (int): Number of lookups which were not.
+        evictions (int): Number of results evicted to stay within the budget.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the result cached for a key, and marks it as the most recently used.
+
+        Args:
+            key (tuple): The key of the query.
+
+        Returns:
+            dict: The cached result (which must not be modified), or None if there is none.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        """
+        Caches the result of a query, evicting the least recently used results if needed.
+
+        Args:
+            key (tuple): The key of the query.
+            result (dict): The result of the query. A result larger than the whole budget is not cached.
+        """
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._nbytes -= previous[1]
+            self._entries[key] = (result, size)
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, predicate):
+        """
+        Drops the cached results whose key matches a predicate (e.g. every result of an ontology which was reloaded).
+
+        Args:
+            predicate (callable): Called with each key, returns True for the keys to drop.
+
+        Returns:
+            int: The number of results dropped.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._nbytes -= self._entries.pop(key)[1]
+            return len(keys)
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        Returns:
+            dict: The number of entries, their estimated size, the budget, and the hit, miss and eviction counters.
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
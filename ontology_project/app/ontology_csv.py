@@ -0,0 +1,118 @@
+import csv
+from array import array
+from itertools import islice
+
+import numpy as np
+
+from ontology_helper import check_required_columns
+from ontology_index import OntologyIndex, csr_from_edges, find_cyclic_nodes
+from ontology_metrics import StageTimings
+
+# Number of rows parsed at a time
+CHUNK_ROWS = 100_000
+
+
+def read_ontology_csv(dir_csv, chunk_rows=CHUNK_ROWS, timings=None):
+    """
+    Builds the index of an ontology by streaming its CSV file, without loading it in a DataFrame.
+
+    The rows are parsed by chunks with the `csv` module. As they go, the Class IDs (of the rows and of their parents)
+    are interned into integer numbers and the parenthood relations are appended to compact integer arrays, so that the
+    memory used is bounded by the index being built rather than by a DataFrame of the whole file. The preprocessing
+    steps are applied on the fly, with the same rules as `preprocess_dataframe`:
+        - the header is checked by `check_required_columns`,
+        - an empty 'Parents' field means no parent, as the 'None' of `replace_nan_values`,
+        - the second, third... occurrences of a label get the suffix of `rename_duplicates`,
+        - the cycles are identified once the file is read, per Class ID as in `identify_cycles`: the rows sharing a
+          Class ID are a single node of the graph of the cycles, so that they are all flagged if any of them is in a
+          cycle.
+    Unlike `pandas.read_csv`, strings such as 'NA' or 'null' are kept as they are instead of being read as missing.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        chunk_rows (int, optional): Number of rows parsed at a time, defaults to `CHUNK_ROWS`.
+        timings (StageTimings, optional): Records the duration of the parsing ('csv_parse', with the number of rows),
+                                          of the construction of the adjacency ('csv_adjacency') and of the index
+                                          ('csv_index', which identifies the cycles). Defaults to None.
+
+    Returns:
+        OntologyIndex: The index of the ontology, with the same codes as `OntologyIndex.from_dataframe` would give.
+
+    Raises:
+        ValueError: If any of the required columns are missing from the csv file.
+    """
+    if timings is None:
+        timings = StageTimings()
+    # The list of parents of an entity may exceed the default limit of the csv module
+    csv.field_size_limit(2 ** 31 - 1)
+    class_ids = []
+    labels = []
+    label_counts = {}
+    id_numbers = {}
+    # Row of the first occurrence of each interned Class ID, -1 for the IDs only met as parents
+    id_rows = array('q')
+    # Interned number of the Class ID of each row
+    row_numbers = array('q')
+    duplicate_ids = False
+    parent_counts = array('q')
+    parent_numbers = array('q')
+
+    with timings.stage('csv_parse'), open(dir_csv, newline='', encoding='utf-8-sig') as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        check_required_columns(header)
+        id_column, label_column, parents_column = (header.index(column)
+                                                   for column in ('Class ID', 'Preferred Label', 'Parents'))
+        width = max(id_column, label_column, parents_column) + 1
+
+        while True:
+            chunk = list(islice(reader, chunk_rows))
+            if not chunk:
+                break
+            for row in chunk:
+                if not row:
+                    continue
+                if len(row) < width:
+                    row = row + [''] * (width - len(row))
+
+                class_id = row[id_column]
+                number = id_numbers.get(class_id)
+                if number is None:
+                    number = id_numbers[class_id] = len(id_rows)
+                    id_rows.append(len(class_ids))
+                elif id_rows[number] == -1:
+                    id_rows[number] = len(class_ids)
+                else:
+                    duplicate_ids = True
+                row_numbers.append(number)
+                class_ids.append(class_id)
+
+                label = row[label_column]
+                occurrence = label_counts[label] = label_counts.get(label, 0) + 1
+                labels.append(label if occurrence == 1 else f'{label}_{occurrence}')
+
+                parent_ids = (row[parents_column] or 'None').split('|')
+                for parent_id in parent_ids:
+                    number = id_numbers.get(parent_id)
+                    if number is None:
+                        number = id_numbers[parent_id] = len(id_rows)
+                        id_rows.append(-1)
+                    parent_numbers.append(number)
+                parent_counts.append(len(parent_ids))
+
+    timings.count('csv_parse', len(class_ids))
+    del label_counts, id_numbers
+    with timings.stage('csv_adjacency'):
+        sources = np.repeat(np.arange(len(class_ids), dtype=np.int64), np.frombuffer(parent_counts, dtype=np.int64))
+        parent_rows = np.frombuffer(id_rows, dtype=np.int64)[np.frombuffer(parent_numbers, dtype=np.int64)]
+        is_known = parent_rows >= 0
+        parent_offsets, parent_codes = csr_from_edges(sources[is_known], parent_rows[is_known], len(class_ids))
+    with timings.stage('csv_index'):
+        in_cycle = None
+        if duplicate_ids:
+            # The parents of every row of a duplicated Class ID point to the first row of their ID, so that the cycles
+            # going through its other rows are only found on the graph of the Class IDs
+            id_offsets, id_parents = csr_from_edges(np.frombuffer(row_numbers, dtype=np.int64)[sources],
+                                                    np.frombuffer(parent_numbers, dtype=np.int64), len(id_rows))
+            in_cycle = find_cyclic_nodes(id_offsets, id_parents)[np.frombuffer(row_numbers, dtype=np.int64)]
+        return OntologyIndex(class_ids, labels, parent_offsets, parent_codes.astype(np.int32), in_cycle)
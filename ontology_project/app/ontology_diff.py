@@ -0,0 +1,327 @@
+import hashlib
+import json
+import math
+import re
+from collections import ChainMap, deque
+
+import numpy as np
+
+from ontology_index import (AncestorClosure, OntologyIndex, collect_ancestors, find_cyclic_nodes,
+                            strongly_connected_components)
+
+REQUIRED_FIELDS = ('Class ID', 'Preferred Label', 'Parents')
+# Number of lookup layers stacked by successive diffs before they are merged back into a single dictionary
+MAX_LOOKUP_LAYERS = 8
+# Suffix appended by `rename_duplicates` to the second, third... occurrences of a label
+_DUPLICATE_SUFFIX = re.compile(r'(.*)_([0-9]+)', re.DOTALL)
+
+
+def _parse_row(row):
+    """
+    Checks a row of a diff and splits its parents, with the same rules as `check_required_columns` and
+    `replace_nan_values`.
+
+    Returns:
+        tuple: The 'Class ID', the 'Preferred Label' and the list of parent IDs of the row.
+
+    Raises:
+        ValueError: If a field is missing, or if the 'Class ID' or the 'Preferred Label' is not a non-empty string.
+    """
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in row]
+    if missing_fields:
+        raise ValueError(f"The following columns are missing in a row of the diff: {', '.join(missing_fields)}")
+    # A node without an ID or a label could no longer be queried, changed or removed
+    for field in ('Class ID', 'Preferred Label'):
+        if not isinstance(row[field], str) or row[field] == '':
+            raise ValueError(f"The field '{field}' of a row of the diff must be a non-empty string, got {row[field]!r}")
+    parents = row['Parents']
+    if parents is None or (isinstance(parents, float) and math.isnan(parents)) or parents == '':
+        parents = 'None'
+    return row['Class ID'], row['Preferred Label'], parents.split('|')
+
+
+def _layered(lookup, overlay):
+    """
+    Stacks the entries changed by a diff on top of a lookup dictionary, without copying it. A key mapped to None in
+    `overlay` is removed from the lookup.
+    """
+    maps = lookup.maps if isinstance(lookup, ChainMap) else [lookup]
+    layered = ChainMap(overlay, *maps)
+    if len(layered.maps) > MAX_LOOKUP_LAYERS:
+        layered = {key: code for key, code in layered.items() if code is not None}
+    return layered
+
+
+def _raw_label(index, code):
+    """
+    Returns the label of a node as it was before `rename_duplicates` added a suffix to it.
+
+    A label 'X_k' (k >= 2) is recognized as the k-th occurrence of 'X' when 'X' is the label of a node with a lower
+    code.
+    """
+    label = index.labels[code]
+    match = _DUPLICATE_SUFFIX.fullmatch(label)
+    if match is not None and int(match[2]) >= 2:
+        first = index.code_of(match[1])
+        if first is not None and first < code:
+            return match[1]
+    return label
+
+
+def _label_group(index, raw_label):
+    """
+    Returns the codes of the nodes whose label is `raw_label` before renaming, in increasing order.
+    """
+    first = index.code_of(raw_label)
+    if first is None:
+        return []
+    group = [first]
+    while True:
+        code = index.code_of(f'{raw_label}_{len(group) + 1}')
+        if code is None or code <= group[-1]:
+            return group
+        group.append(code)
+
+
+def _splice_csr(offsets, columns, rows, size):
+    """
+    Replaces some rows of a CSR structure, and appends empty rows up to `size` rows.
+
+    The unchanged rows are copied as whole slices between the replaced ones, so that the cost is a copy of the arrays
+    rather than a rebuild.
+
+    Args:
+        offsets (numpy.ndarray): Offsets of each row in the columns.
+        columns (tuple): Arrays sharing the offsets (e.g. the ancestors of a closure and their depths).
+        rows (dict): Maps the code of each replaced row to a tuple of sequences, one per column.
+        size (int): Number of rows of the result, at least the current one.
+
+    Returns:
+        tuple: The new offsets, followed by the new columns.
+    """
+    old_size = len(offsets) - 1
+    lengths = np.zeros(size, dtype=np.int64)
+    lengths[:old_size] = np.diff(offsets)
+    for code, values in rows.items():
+        lengths[code] = len(values[0])
+    new_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+
+    pieces = [[] for _ in columns]
+    position = 0
+    for code in sorted(rows):
+        start = offsets[code] if code < old_size else offsets[old_size]
+        for piece, column, values in zip(pieces, columns, rows[code]):
+            piece.append(column[position:start])
+            piece.append(np.asarray(values, dtype=column.dtype))
+        position = offsets[code + 1] if code < old_size else start
+    for piece, column in zip(pieces, columns):
+        piece.append(column[position:])
+    return (new_offsets,) + tuple(np.concatenate(piece) for piece in pieces)
+
+
+def _cycle_region(index, sources):
+    """
+    Returns the nodes which may share a cycle with one of `sources`: the ancestors of the sources from which a source
+    can be reached again. Every strongly connected component containing a source lies in this region.
+    """
+    ancestors = set(sources)
+    queue = deque(sources)
+    while queue:
+        for parent in index.parents_of(queue.popleft()):
+            if parent not in ancestors:
+                ancestors.add(parent)
+                queue.append(parent)
+
+    region = set(sources)
+    queue = deque(sources)
+    while queue:
+        for child in index.children_of(queue.popleft()):
+            if child in ancestors and child not in region:
+                region.add(child)
+                queue.append(child)
+    return region
+
+
+def _descendant_cone(index, sources):
+    """
+    Returns the sources and all their descendants.
+    """
+    cone = set(sources)
+    queue = deque(sources)
+    while queue:
+        for child in index.children_of(queue.popleft()):
+            if child not in cone:
+                cone.add(child)
+                queue.append(child)
+    return cone
+
+
+def apply_diff(index, added=(), removed=(), changed=()):
+    """
+    Applies a diff between two releases of an ontology to its index, without rebuilding it.
+
+    The index is not modified: a new index is returned, sharing the unchanged data of the current one, so that it can
+    be swapped in place of it while queries are still running on it. Only the structures touched by the diff are
+    recomputed:
+        - the parent and children adjacencies, whose changed rows are spliced into copies of the arrays,
+        - the cycle flags and components, recomputed on the region where a cycle can go through a changed row,
+        - the labels sharing a base label with a changed row, renumbered as `rename_duplicates` does,
+        - the rows of the ancestor closure (if precomputed) of the descendants of the changed rows.
+
+    The result is the index of the CSV file where the changed rows are edited in place, the removed rows are deleted
+    and the added rows are appended at the end, except that the removed rows keep their code (with None as Class ID
+    and label) and that rows referencing a Class ID which was unknown when they were indexed are not linked to it when
+    it is added: such rows must be part of the diff as well.
+
+    The first diff applied to an index loaded from a snapshot also decodes its labels and Class IDs into lists (about
+    1.2s at 1M entities), the following ones reuse them.
+
+    Args:
+        index (OntologyIndex): The current index of the ontology.
+        added (iterable, optional): The new rows, as dictionaries with 'Class ID', 'Preferred Label' and 'Parents'.
+        removed (iterable, optional): The 'Class ID' of the removed rows.
+        changed (iterable, optional): The new version of the changed rows, as dictionaries like `added`.
+
+    Returns:
+        OntologyIndex: The updated index, whose version is derived from the version of `index` and the diff.
+
+    Raises:
+        ValueError: If a row misses a column, if an added Class ID is already present, if a removed or changed one is
+                    not, or if a Class ID appears several times in the diff.
+    """
+    added = [_parse_row(row) for row in added]
+    changed = [_parse_row(row) for row in changed]
+    removed = list(removed)
+
+    id_to_code = index.id_to_code
+    diff_ids = removed + [class_id for class_id, _, _ in changed + added]
+    if len(set(diff_ids)) != len(diff_ids):
+        raise ValueError('A Class ID appears several times in the diff.')
+    for class_id in removed + [class_id for class_id, _, _ in changed]:
+        if id_to_code.get(class_id) is None:
+            raise ValueError(f"The Class ID '{class_id}' is not present in the ontology.")
+    for class_id, _, _ in added:
+        if id_to_code.get(class_id) is not None:
+            raise ValueError(f"The Class ID '{class_id}' is already present in the ontology.")
+
+    old_size = len(index)
+    size = old_size + len(added)
+    removed_codes = [id_to_code[class_id] for class_id in removed]
+    removed_set = set(removed_codes)
+    rows = {id_to_code[class_id]: (label, parent_ids) for class_id, label, parent_ids in changed}
+    rows.update((old_size + position, (label, parent_ids)) for position, (_, label, parent_ids) in enumerate(added))
+
+    class_ids = list(index.class_ids)
+    class_ids.extend(class_id for class_id, _, _ in added)
+    id_overlay = {class_id: old_size + position for position, (class_id, _, _) in enumerate(added)}
+    for code in removed_codes:
+        id_overlay[class_ids[code]] = None
+        class_ids[code] = None
+    new_id_to_code = _layered(id_to_code, id_overlay)
+
+    # Parent adjacency: the changed and added rows, the removed rows and the children of the removed rows
+    parent_rows = {}
+    for code, (_, parent_ids) in rows.items():
+        parents = (new_id_to_code.get(parent_id) for parent_id in parent_ids)
+        parent_rows[code] = [parent for parent in parents if parent is not None]
+    for code in removed_codes:
+        parent_rows[code] = []
+    for code in removed_codes:
+        for child in index.children_of(code):
+            if child not in parent_rows:
+                parent_rows[child] = [parent for parent in index.parents_of(child) if parent not in removed_set]
+
+    # Children adjacency: the parents gaining or losing a child
+    child_rows = {}
+    for code, parents in parent_rows.items():
+        for parent in (index.parents_of(code) if code < old_size else []):
+            if parent not in child_rows:
+                child_rows[parent] = index.children_of(parent)
+            child_rows[parent].remove(code)
+        for parent in parents:
+            if parent not in child_rows:
+                child_rows[parent] = index.children_of(parent) if parent < old_size else []
+            child_rows[parent].append(code)
+    for children in child_rows.values():
+        children.sort()
+
+    parent_offsets, parent_codes = _splice_csr(index.parent_offsets, (index.parent_codes,),
+                                               {code: (parents,) for code, parents in parent_rows.items()}, size)
+    child_offsets, child_codes = _splice_csr(index.child_offsets, (index.child_codes,),
+                                             {code: (children,) for code, children in child_rows.items()}, size)
+
+    # Labels: every group of labels sharing a base label with a changed row is renumbered in the order of the codes
+    labels = list(index.labels)
+    labels.extend([None] * len(added))
+    groups = {}
+    for code in removed_codes + [code for code in rows if code < old_size]:
+        groups.setdefault(_raw_label(index, code), None)
+    for _, (label, _) in rows.items():
+        groups.setdefault(label, None)
+    label_overlay = {}
+    for raw_label in groups:
+        old_group = _label_group(index, raw_label)
+        for code in old_group:
+            label_overlay[index.labels[code]] = None
+            labels[code] = None
+        groups[raw_label] = [code for code in old_group if code not in removed_set and code not in rows]
+    for code, (label, _) in rows.items():
+        groups[label].append(code)
+    for code in removed_codes:
+        label_overlay.setdefault(index.labels[code], None)
+        labels[code] = None
+    for raw_label, group in groups.items():
+        for position, code in enumerate(sorted(group)):
+            label = raw_label if position == 0 else f'{raw_label}_{position + 1}'
+            labels[code] = label
+            label_overlay[label] = code
+
+    new_index = OntologyIndex(class_ids, labels, parent_offsets, parent_codes,
+                              np.concatenate((index.in_cycle, np.zeros(size - old_size, dtype=bool))),
+                              child_offsets=child_offsets, child_codes=child_codes)
+    new_index.id_to_code = new_id_to_code
+    new_index.label_to_code = _layered(index.label_to_code, label_overlay)
+
+    # Cycles: the components can only change on the region where a cycle goes through a row whose parents changed,
+    # before or after the diff
+    touched = list(parent_rows)
+    region = _cycle_region(new_index, touched)
+    region |= _cycle_region(index, [code for code in touched if code < old_size and index.in_cycle[code]])
+    nodes = sorted(region)
+    local_codes = {code: position for position, code in enumerate(nodes)}
+    local_offsets = [0]
+    local_parents = []
+    for code in nodes:
+        local_parents.extend(local_codes[parent] for parent in new_index.parents_of(code) if parent in local_codes)
+        local_offsets.append(len(local_parents))
+    local_offsets = np.asarray(local_offsets, dtype=np.int64)
+    local_parents = np.asarray(local_parents, dtype=np.int64)
+    local_component = strongly_connected_components(local_offsets, local_parents)
+    nodes = np.asarray(nodes, dtype=np.int64)
+    new_index.in_cycle[nodes] = find_cyclic_nodes(local_offsets, local_parents, local_component)
+    if 'component' in index.__dict__:
+        # Fresh numbers for the components of the region, the others keep theirs
+        component = np.concatenate((index.component, np.zeros(size - old_size, dtype=index.component.dtype)))
+        component[nodes] = local_component + (int(index.component.max()) + 1 if old_size else 0)
+        new_index.component = component
+
+    closure = index.closure
+    if closure is not None:
+        cone = _descendant_cone(new_index, touched) | _descendant_cone(index, [code for code in touched if code < old_size])
+        closure_rows = {}
+        for code in cone:
+            row = {} if code in removed_set else collect_ancestors(new_index, code, closure.depth)
+            row.pop(code, None)
+            closure_rows[code] = (list(row.keys()), list(row.values()))
+        max_depth = max((max(depths) for _, depths in closure_rows.values() if depths), default=0)
+        depths = closure.depths.astype(np.promote_types(closure.depths.dtype, np.min_scalar_type(max_depth)))
+        new_index.closure = AncestorClosure(closure.depth,
+                                            *_splice_csr(closure.offsets, (closure.ancestors, depths), closure_rows, size),
+                                            build_seconds=closure.build_seconds)
+
+    if index.version is not None:
+        diff = json.dumps([sorted(removed), sorted(map(str, changed)), sorted(map(str, added))])
+        digest = hashlib.sha1(f'{index.version}\n{diff}'.encode('utf-8')).hexdigest()[:12]
+        new_index.version = f"{index.version.partition('+')[0]}+{digest}"
+    return new_index
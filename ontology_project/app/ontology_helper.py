@@ -1,4 +1,9 @@
-import networkx as nx
+import heapq
+
+import numpy as np
+from ontology_index import (DIRECTIONS, OntologyIndex, collect_ancestors, collect_descendants, csr_from_edges,
+                            find_cyclic_nodes)
+from ontology_metrics import StageTimings
 
 
 def check_required_columns(dataframe):
@@ -6,14 +11,15 @@ def check_required_columns(dataframe):
     Checks if the required columns are present in the DataFrame.
 
     Args:
-        dataframe (pandas.DataFrame): The DataFrame to check for required columns.
+        dataframe (pandas.DataFrame or list): The DataFrame to check for required columns, or the header of the csv
+                                              file when it is read without pandas.
 
     Raises:
         ValueError: If any of the required columns are missing from the DataFrame.
     """
 
     required_columns = {'Class ID', 'Preferred Label', 'Parents'}
-    missing_columns = required_columns - set(dataframe.columns)
+    missing_columns = required_columns - set(getattr(dataframe, 'columns', dataframe))
     if missing_columns:
         raise ValueError(f'The following columns are missing in the csv file: {', '.join(missing_columns)}')
 
@@ -29,7 +35,8 @@ def replace_nan_values(dataframe):
         pandas.DataFrame: The DataFrame with NaN values in the 'Parents' column replaced by 'None'.
     """
 
-    dataframe['Parents'] = dataframe['Parents'].apply(lambda x: 'None' if isinstance(x, float) else x)
+    parents = dataframe['Parents']
+    dataframe['Parents'] = parents.where(parents.notna(), 'None')
     return dataframe
 
 
@@ -37,7 +44,8 @@ def rename_duplicates(column):
     """
     Renames duplicate values in a column by appending a suffix to each duplicate.
 
-    This function iterates through a given column and appends a suffix (e.g., '_2', '_3') to each duplicate value.
+    This function numbers the occurrences of each value with a grouped cumulative count, and appends a suffix
+    (e.g., '_2', '_3') to each duplicate value.
 
     Args:
         column (pandas.Series): A pandas Series or list containing the values to be checked for duplicates.
@@ -45,18 +53,14 @@ def rename_duplicates(column):
     Returns:
         list: A list of values where duplicates have been renamed with a suffix.
     """
-    counts = {}
-    new_values = []
-
-    for value in column:
-        if value not in counts:
-            counts[value] = 1
-            new_values.append(value)
-        else:
-            counts[value] += 1
-            new_values.append(f'{value}_{counts[value]}')
+    import pandas as pd
 
-    return new_values
+    values = pd.Series(column, dtype=object).reset_index(drop=True)
+    occurrence = values.groupby(values, sort=False, dropna=False).cumcount() + 1
+    is_duplicate = occurrence > 1
+    new_values = values.copy()
+    new_values[is_duplicate] = values[is_duplicate].astype(str) + '_' + occurrence[is_duplicate].astype(str)
+    return new_values.tolist()
 
 
 def identify_cycles(dataframe):
@@ -64,8 +68,10 @@ def identify_cycles(dataframe):
     Identifies cycles in a directed graph formed from the DataFrame's 'Class ID' and 'Parents' columns.
 
     This function builds a directed graph where each 'Class ID' is a node and the 'Parents' represent directed edges.
-    It then checks if there are any cycles in the graph. If cycles are detected, it marks the nodes involved in the cycle
-    by adding a new column 'In Cycle' to the DataFrame, with `True` for nodes in a cycle and `False` otherwise.
+    The edge list is obtained by exploding the 'Parents' column, and the IDs are factorized into integer codes. The
+    strongly connected components of the graph are then computed in linear time: every node belonging to a component
+    of several nodes (or having itself as parent) is part of a cycle. The nodes involved in a cycle are marked by adding
+    a new column 'In Cycle' to the DataFrame, with `True` for nodes in a cycle and `False` otherwise.
 
     Args:
         dataframe (pandas.DataFrame): The DataFrame containing 'Class ID' and 'Parents' columns.
@@ -77,21 +83,20 @@ def identify_cycles(dataframe):
     Raises:
         ValueError: If the DataFrame does not contain the necessary columns ('Class ID', 'Parents').
     """
-    graph = nx.DiGraph()
-    for _, row in dataframe.iterrows():
-        for parent in row['Parents'].split('|'):
-            graph.add_edge(row['Class ID'], parent)
-
-    try:
-        cycle_edges = nx.find_cycle(graph, orientation="original")
-        cycle_nodes = set(node for edge in cycle_edges for node in edge)
-    except nx.NetworkXNoCycle:
-        cycle_nodes = set()
-    dataframe['In Cycle'] = dataframe['Class ID'].apply(lambda x: x in cycle_nodes)
+    import pandas as pd
+
+    edges = dataframe[['Class ID']].assign(Parent=dataframe['Parents'].str.split('|')).explode('Parent')
+    codes, ids = pd.factorize(np.concatenate((dataframe['Class ID'].to_numpy(dtype=object),
+                                              edges['Class ID'].to_numpy(dtype=object),
+                                              edges['Parent'].to_numpy(dtype=object))))
+    row_codes, codes = codes[:len(dataframe)], codes[len(dataframe):].reshape(2, -1)
+    offsets, parent_codes = csr_from_edges(codes[0], codes[1], len(ids))
+
+    dataframe['In Cycle'] = find_cyclic_nodes(offsets, parent_codes)[row_codes]
     return dataframe
 
 
-def preprocess_dataframe(dataframe):
+def preprocess_dataframe(dataframe, timings=None):
     """
     Preprocesses the input DataFrame in a standard format.
 
@@ -99,61 +104,88 @@ def preprocess_dataframe(dataframe):
 
     Args:
         dataframe (pandas.DataFrame): The DataFrame built from the provided csv file.
+        timings (StageTimings, optional): Records the duration of each of the previous functions, as a stage named
+                                          after it. Defaults to None.
 
     Returns:
         pandas.DataFrame: The original DataFrame with an additional 'In Cycle' column indicating whether each node
                           is part of a cycle, duplicates removed and NaN values replaced.
     """
-    check_required_columns(dataframe)
-    dataframe = replace_nan_values(dataframe)
-    dataframe['Preferred Label'] = rename_duplicates(dataframe['Preferred Label'])
-    dataframe = identify_cycles(dataframe)
+    if timings is None:
+        timings = StageTimings()
+    with timings.stage('check_required_columns'):
+        check_required_columns(dataframe)
+    with timings.stage('replace_nan_values'):
+        dataframe = replace_nan_values(dataframe)
+    with timings.stage('rename_duplicates'):
+        dataframe['Preferred Label'] = rename_duplicates(dataframe['Preferred Label'])
+    with timings.stage('identify_cycles'):
+        dataframe = identify_cycles(dataframe)
     return dataframe
 
 
-def get_ontology(entity_label, dataframe, level=0, ontology=None):
+def get_ontology(entity_label, dataframe, level=0, ontology=None, depth='shortest', direction='ancestors', memo=None,
+                 codes=None):
     """
-    Recursively deduces a parenthood relation from a DataFrame for a given label.
+    Deduces the parenthood relations of a given label from the ontology.
 
-    This function explores an ontology represented as a DataFrame, recursively building a parent-child hierarchy.
-    It starts from the given `entity_label` and explores its parent labels, incrementing the `level` for each
-    level of parenthood. If a cycle is detected, it will mark the entity as being in a cyclic relationship.
+    This function explores the ancestors of `entity_label` with a breadth-first search over the integer parent
+    adjacency of an `OntologyIndex`, so that each ancestor is visited only once, even when it is shared by several
+    branches or part of a cycle. Its descendants can be explored the same way through the reverse (children) adjacency
+    of the index: their levels are then negative.
     The result is a dictionary where the keys are entity labels and the values are their corresponding levels
-    in the parent-child hierarchy, or a message indicating a cycle.
+    in the parent-child hierarchy.
 
     Args:
     entity_label (str): The label of the entity to start the parenthood search from.
-    dataframe (pandas.DataFrame): The DataFrame containing the ontology with 'Preferred Label' and 'Parents' columns.
-    level (int, optional): The current level in the parent-child hierarchy, defaults to 0.
+    dataframe (pandas.DataFrame or OntologyIndex): The preprocessed DataFrame containing the ontology with
+                                                   'Class ID', 'Preferred Label', 'Parents' and 'In Cycle' columns,
+                                                   or its index (preferred, as it is built only once).
+    level (int, optional): The level given to `entity_label`, defaults to 0.
     ontology (dict, optional): A dictionary to accumulate the results, defaults to None.
+    depth (str, optional): 'shortest' to give each relative the length of its shortest path to the entity, or
+                           'longest' for the longest one (the entities of a same cycle then share the same level),
+                           defaults to 'shortest'.
+    direction (str, optional): 'ancestors', 'descendants' or 'both', defaults to 'ancestors'.
+    memo (RelativesMemo, optional): A memo shared by several queries on the same index (for instance a batch of
+                                    labels), in which case its depth mode is used instead of `depth`. Defaults to None.
+    codes (dict, optional): A dictionary filled with the code of each relative, by label, e.g. to rank the relatives
+                            of a same level without looking their labels up in the index. Defaults to None.
 
     Returns:
     dict: A dictionary where the keys are entity labels and the values are their corresponding levels in the ontology
-          hierarchy, or a message indicating a cycle if detected.
+          hierarchy (negative for descendants).
 
-    """
+    Raises:
+    ValueError: If `depth` or `direction` is not one of the supported values.
 
+    """
 
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Unknown direction '{direction}', expected one of: {', '.join(DIRECTIONS)}")
     if ontology is None:
         ontology = {}
 
-    df_tmp = dataframe[dataframe['Preferred Label'] == entity_label]
-    if df_tmp.empty:
+    index = dataframe if isinstance(dataframe, OntologyIndex) else OntologyIndex.from_dataframe(dataframe)
+    start = index.code_of(entity_label)
+    if start is None:
         return ontology
 
-    ontology[entity_label] = level
-
-    parent_ids = df_tmp['Parents'].iloc[0]
-
-    for parent_id in parent_ids.split('|'):
-        parent_row = dataframe[dataframe['Class ID'] == parent_id]
-        if not parent_row.empty:
-            if parent_row['In Cycle'].iloc[0] == True:
-                ontology[
-                    entity_label] = f"Entered a cyclic parenthood at level {level} (direct parents: {df_tmp['Parents'].iloc[0]}). The parenthood concerning the {parent_row['Preferred Label'].iloc[0]}'s branch will be ignored."
-            else:
-                parent_label = parent_row['Preferred Label'].iloc[0]
-                get_ontology(parent_label, dataframe, level + 1, ontology)
+    depths = {}
+    if direction != 'ancestors':
+        depths.update(memo.descendants(start) if memo is not None else collect_descendants(index, start, depth))
+    if direction != 'descendants':
+        depths.update(memo.ancestors(start) if memo is not None else collect_ancestors(index, start, depth))
+
+    labels = index.labels
+    if codes is None:
+        for code, relative_depth in depths.items():
+            ontology[labels[code]] = level + relative_depth
+    else:
+        for code, relative_depth in depths.items():
+            label = labels[code]
+            ontology[label] = level + relative_depth
+            codes[label] = code
 
     return ontology
 
@@ -209,3 +241,63 @@ def sort_dictionary(dictionary):
               appear first (sorted in descending order), followed by other values (also sorted in descending order).
     """
     return {k: v for k, v in sorted(dictionary.items(), key=lambda item: (isinstance(item[1], str), item[1]), reverse=True)}
+
+
+def select_first_entities(dictionary, n, rank=None):
+    """
+    Returns the first `n` items of a dictionary sorted like `sort_dictionary`, without sorting the whole dictionary.
+
+    When `n` is small compared to the size of the dictionary, the items are selected with a heap in O(len * log(n))
+    instead of being all sorted. The values must be numbers (levels), sorted in descending order.
+
+    Args:
+        dictionary (dict): The dictionary to select the items from.
+        n (int): The number of items kept.
+        rank (callable, optional): Gives the position of a key among the keys of equal value (e.g. `index.code_of`,
+                                   for the order of the rows of the csv file). Defaults to the order of the dictionary.
+
+    Returns:
+        dict: The first `n` items, in order.
+    """
+    if rank is None:
+        positions = {key: position for position, key in enumerate(dictionary)}
+        rank = positions.__getitem__
+    items = dictionary.items()
+    key = lambda item: (-item[1], rank(item[0]))
+    if 4 * n < len(dictionary):
+        return dict(heapq.nsmallest(n, items, key=key))
+    return dict(sorted(items, key=key)[:max(n, 0)])
+
+
+def select_first_dense_entities(index, onto_dict, n, rank=None):
+    """
+    Returns the first `n` items of the dense result of a query, without building it.
+
+    The result is the same as the first `n` items of
+    `sort_dictionary(fill_dictionary_with_ontology_results(index.empty_dictionary(), onto_dict))`: the ancestors by
+    decreasing level, then the entities at level 0 (including the ones unrelated to the queried entity) in the order
+    of the csv file, then the descendants. Only the entities which end up in the result are visited.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        onto_dict (dict): The result of `get_ontology` on the index.
+        n (int): The number of items kept.
+        rank (callable, optional): Gives the code of a label of `onto_dict` (see `get_ontology`). Defaults to
+                                   `index.code_of`.
+
+    Returns:
+        dict: The first `n` items, in order.
+    """
+    if rank is None:
+        rank = index.code_of
+    result = select_first_entities({label: level for label, level in onto_dict.items() if level > 0}, n, rank)
+    if len(result) < n:
+        for label in index.labels:
+            if label is not None and not onto_dict.get(label, 0):
+                result[label] = 0
+                if len(result) == n:
+                    break
+    if len(result) < n:
+        result.update(select_first_entities({label: level for label, level in onto_dict.items() if level < 0},
+                                            n - len(result), rank))
+    return result
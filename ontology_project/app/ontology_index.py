@@ -0,0 +1,584 @@
+import time
+from array import array
+from collections import deque
+from functools import cached_property
+
+import numpy as np
+
+DEPTH_MODES = ('shortest', 'longest')
+DIRECTIONS = ('ancestors', 'descendants', 'both')
+
+
+class OntologyIndex:
+    """
+    In-memory index of a preprocessed ontology, built once and shared by every query.
+
+    Each row of the preprocessed DataFrame becomes a node identified by its integer code (its row position). The index
+    keeps the Class ID / Preferred Label lookups as plain dictionaries and the parenthood relations as CSR-style
+    integer arrays: the parents of the node `code` are `parent_codes[parent_offsets[code]:parent_offsets[code + 1]]`.
+    The reverse (parent to children) adjacency is built at the same time, in the same format. The lookup dictionaries
+    are only built the first time they are used.
+
+    Attributes:
+        class_ids (list): The 'Class ID' of each node, indexed by code.
+        labels (list): The 'Preferred Label' of each node, indexed by code.
+        id_to_code (dict): Maps a 'Class ID' to its code (first occurrence if the ID is duplicated).
+        label_to_code (dict): Maps a 'Preferred Label' to its code.
+        parent_offsets (numpy.ndarray): Offsets of each node's parents in `parent_codes`, of length `len(self) + 1`.
+        parent_codes (numpy.ndarray): Codes of the parents of every node, concatenated.
+        child_offsets (numpy.ndarray): Offsets of each node's children in `child_codes`, of length `len(self) + 1`.
+        child_codes (numpy.ndarray): Codes of the children of every node, concatenated.
+        in_cycle (numpy.ndarray): Boolean array, `True` for the nodes flagged as part of a cycle.
+        closure (AncestorClosure): The precomputed ancestor closure, None until `precompute_closure` is called.
+        label_search (LabelSearch): The search index of the labels, None until the service builds it (see
+                                    `get_label_search`) unless the index is loaded from a snapshot.
+        version (str): Identifier of the source data the index was built from, set by the service that loads it (None
+                       for an index built directly).
+    """
+
+    def __init__(self, class_ids, labels, parent_offsets, parent_codes, in_cycle=None, child_offsets=None,
+                 child_codes=None, component=None):
+        self.class_ids = class_ids
+        self.labels = labels
+        self.parent_offsets = parent_offsets
+        self.parent_codes = parent_codes
+        self.closure = None
+        self.label_search = None
+        self.version = None
+        if child_offsets is None or child_codes is None:
+            child_offsets, child_codes = _reverse_adjacency(parent_offsets, parent_codes)
+        self.child_offsets = child_offsets
+        self.child_codes = child_codes
+        if component is not None:
+            self.component = component
+        if in_cycle is None:
+            in_cycle = find_cyclic_nodes(parent_offsets, parent_codes, self.component)
+        self.in_cycle = in_cycle
+
+    @cached_property
+    def id_to_code(self):
+        id_to_code = {}
+        for code, class_id in enumerate(self.class_ids):
+            id_to_code.setdefault(class_id, code)
+        return id_to_code
+
+    @cached_property
+    def label_to_code(self):
+        return {label: code for code, label in enumerate(self.labels)}
+
+    @classmethod
+    def from_dataframe(cls, dataframe):
+        """
+        Builds the index from a DataFrame returned by `preprocess_dataframe`.
+
+        Parent IDs which do not match any 'Class ID' (e.g. 'None') are not kept in the adjacency.
+
+        Args:
+            dataframe (pandas.DataFrame): The preprocessed DataFrame, with 'Class ID', 'Preferred Label', 'Parents'
+                                          and 'In Cycle' columns.
+
+        Returns:
+            OntologyIndex: The index of the ontology.
+        """
+        import pandas as pd
+
+        class_ids = dataframe['Class ID'].tolist()
+
+        # One edge per (row, parent ID): parent IDs are resolved to the row of their first occurrence as 'Class ID'
+        parent_ids = dataframe['Parents'].str.split('|')
+        children = np.repeat(np.arange(len(class_ids)), parent_ids.str.len().to_numpy(dtype=np.int64))
+        known_ids = dataframe['Class ID'].reset_index(drop=True).drop_duplicates()
+        positions = pd.Index(known_ids).get_indexer(parent_ids.explode().to_numpy(dtype=object))
+        is_known = positions >= 0
+        parent_offsets, parent_codes = csr_from_edges(children[is_known],
+                                                      known_ids.index.to_numpy()[positions[is_known]],
+                                                      len(class_ids))
+
+        return cls(class_ids,
+                   dataframe['Preferred Label'].tolist(),
+                   parent_offsets,
+                   parent_codes.astype(np.int32),
+                   dataframe['In Cycle'].to_numpy(dtype=bool))
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    def __contains__(self, label):
+        return self.code_of(label) is not None
+
+    def code_of(self, label):
+        """
+        Returns the code of a node from its 'Preferred Label'.
+
+        Args:
+            label (str): The 'Preferred Label' of the node.
+
+        Returns:
+            int: The code of the node, or None if the label is not in the ontology.
+        """
+        return self.label_to_code.get(label)
+
+    def parents_of(self, code):
+        """
+        Returns the codes of the direct parents of a node.
+
+        Args:
+            code (int): The code of the node.
+
+        Returns:
+            list: The codes of its direct parents, in the order of the 'Parents' column.
+        """
+        return self.parent_codes[self.parent_offsets[code]:self.parent_offsets[code + 1]].tolist()
+
+    def children_of(self, code):
+        """
+        Returns the codes of the direct children of a node.
+
+        Args:
+            code (int): The code of the node.
+
+        Returns:
+            list: The codes of its direct children, in the order of their rows.
+        """
+        return self.child_codes[self.child_offsets[code]:self.child_offsets[code + 1]].tolist()
+
+    @cached_property
+    def component(self):
+        """
+        numpy.ndarray: The strongly connected component of each node. The nodes of a same cycle share the same
+        component, and the parenthood relations between components form a DAG (the condensation of the ontology).
+        """
+        return strongly_connected_components(self.parent_offsets, self.parent_codes)
+
+    def precompute_closure(self, depth='shortest'):
+        """
+        Materializes the ancestor closure of every node, so that the next searches are answered by an array slice.
+
+        Args:
+            depth (str, optional): The depth mode the closure is computed for, defaults to 'shortest'. Searches made with
+                                   the other mode still go through the graph.
+
+        Returns:
+            AncestorClosure: The closure, also stored in `self.closure`.
+        """
+        self.closure = None
+        self.closure = AncestorClosure.build(self, depth)
+        return self.closure
+
+    def empty_dictionary(self):
+        """
+        Equivalent of `initialize_empty_dictionary_from_df`, built from the labels already held by the index.
+
+        Returns:
+            dict: A dictionary with every 'Preferred Label' as key and 0 as value.
+        """
+        dictionary = dict.fromkeys(self.labels, 0)
+        # The rows removed by `apply_diff` keep their code, with None as label
+        dictionary.pop(None, None)
+        return dictionary
+
+
+def csr_from_edges(sources, targets, size):
+    """
+    Builds a CSR adjacency from an edge list.
+
+    Args:
+        sources (numpy.ndarray): Code of the source node of each edge.
+        targets (numpy.ndarray): Code of the target node of each edge.
+        size (int): Number of nodes.
+
+    Returns:
+        tuple: The offsets (of length `size + 1`) and the concatenated targets of each node, in the order of the edges.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    order = np.argsort(sources, kind='stable')
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=size), out=offsets[1:])
+    return offsets, np.asarray(targets)[order]
+
+
+def _reverse_adjacency(offsets, codes):
+    """
+    Inverts a CSR adjacency: returns the offsets and codes giving, for each node, the nodes pointing to it.
+    """
+    size = len(offsets) - 1
+    sources = np.repeat(np.arange(size, dtype=codes.dtype), np.diff(offsets))
+    return csr_from_edges(codes, sources, size)
+
+
+def strongly_connected_components(offsets, codes):
+    """
+    Computes the strongly connected components of a directed graph given as a CSR adjacency.
+
+    This is an iterative version of Tarjan's algorithm, running in linear time without being limited by the recursion
+    depth. The components are numbered in reverse topological order: the successors of a component have lower numbers.
+
+    Args:
+        offsets (numpy.ndarray): Offsets of each node's successors in `codes`.
+        codes (numpy.ndarray): Codes of the successors of every node, concatenated.
+
+    Returns:
+        numpy.ndarray: The number of the component of each node.
+    """
+    size = len(offsets) - 1
+    offsets = offsets.tolist()
+    codes = codes.tolist()
+    order = [-1] * size
+    low = [0] * size
+    component = [-1] * size
+    stack = []
+    counter = 0
+    components = 0
+
+    for root in range(size):
+        if order[root] != -1:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        work = [(root, offsets[root])]
+        while work:
+            node, position = work[-1]
+            if position < offsets[node + 1]:
+                work[-1] = (node, position + 1)
+                successor = codes[position]
+                if order[successor] == -1:
+                    order[successor] = low[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    work.append((successor, offsets[successor]))
+                elif component[successor] == -1 and order[successor] < low[node]:
+                    low[node] = order[successor]
+                continue
+
+            work.pop()
+            if work and low[node] < low[work[-1][0]]:
+                low[work[-1][0]] = low[node]
+            if low[node] == order[node]:
+                while True:
+                    member = stack.pop()
+                    component[member] = components
+                    if member == node:
+                        break
+                components += 1
+
+    return np.asarray(component, dtype=np.int64)
+
+
+def find_cyclic_nodes(offsets, codes, component=None):
+    """
+    Flags every node which is part of a cycle: the nodes of a component with several nodes, and the self-loops.
+
+    Args:
+        offsets (numpy.ndarray): Offsets of each node's successors in `codes`.
+        codes (numpy.ndarray): Codes of the successors of every node, concatenated.
+        component (numpy.ndarray, optional): The result of `strongly_connected_components`, computed if not given.
+
+    Returns:
+        numpy.ndarray: Boolean array, `True` for the nodes in a cycle.
+    """
+    if component is None:
+        component = strongly_connected_components(offsets, codes)
+    in_cycle = np.bincount(component, minlength=1)[component] > 1
+    sources = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    in_cycle[sources[sources == codes]] = True
+    return in_cycle
+
+
+def collect_ancestors(index, start, depth='shortest'):
+    """
+    Collects the ancestors of a node with a breadth-first search over the parent adjacency of the index.
+
+    Every ancestor is visited once, however many paths lead to it, and the search goes through cycles without being
+    trapped in them. With `depth='shortest'`, the depth of an ancestor is the length of the shortest parenthood path from
+    `start`. With `depth='longest'`, it is the length of the longest path in the condensation of the ontology, where
+    each cycle counts as a single entity: the ancestors belonging to a same cycle share the same depth.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        start (int): The code of the node to start the search from.
+        depth (str, optional): 'shortest' or 'longest', defaults to 'shortest'.
+
+    Returns:
+        dict: A dictionary mapping the code of every visited node (including `start`) to its depth.
+
+    Raises:
+        ValueError: If `depth` is not one of the supported modes.
+    """
+    if depth not in DEPTH_MODES:
+        raise ValueError(f"Unknown depth mode '{depth}', expected one of: {', '.join(DEPTH_MODES)}")
+
+    closure = index.closure
+    if closure is not None and closure.depth == depth:
+        return closure.ancestors_of(start)
+    return _breadth_first(index.parents_of, index.component, start, depth)
+
+
+def collect_descendants(index, start, depth='shortest'):
+    """
+    Collects the descendants of a node with a breadth-first search over the reverse (children) adjacency of the index.
+
+    This is the mirror of `collect_ancestors`: the depths are counted the same way but returned as negative numbers,
+    so that descendants can be told apart from ancestors.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        start (int): The code of the node to start the search from.
+        depth (str, optional): 'shortest' or 'longest', defaults to 'shortest'.
+
+    Returns:
+        dict: A dictionary mapping the code of every visited node (including `start`) to its (negative) depth.
+
+    Raises:
+        ValueError: If `depth` is not one of the supported modes.
+    """
+    if depth not in DEPTH_MODES:
+        raise ValueError(f"Unknown depth mode '{depth}', expected one of: {', '.join(DEPTH_MODES)}")
+
+    depths = _breadth_first(index.children_of, index.component, start, depth)
+    return {code: -node_depth for code, node_depth in depths.items()}
+
+
+def _breadth_first(neighbours_of, component, start, depth):
+    """
+    Breadth-first search shared by `collect_ancestors` and `collect_descendants`.
+    """
+    depths = {start: 0}
+    edges = []
+    queue = deque([start])
+    while queue:
+        code = queue.popleft()
+        next_depth = depths[code] + 1
+        for neighbour in neighbours_of(code):
+            edges.append((code, neighbour))
+            if neighbour not in depths:
+                depths[neighbour] = next_depth
+                queue.append(neighbour)
+
+    if depth == 'longest':
+        _relax_longest_paths(depths, edges, component)
+    return depths
+
+
+def _relax_longest_paths(depths, edges, component):
+    """
+    Replaces in place the shortest depths found by the breadth-first search with the longest ones.
+
+    The explored edges are projected on the strongly connected components, which form a DAG processed in topological
+    order (Kahn's algorithm). Every node then takes the depth of its component.
+    """
+    component_of = {code: int(component[code]) for code in depths}
+    successors = {}
+    in_degree = dict.fromkeys(set(component_of.values()), 0)
+    for code, neighbour in edges:
+        source, target = component_of[code], component_of[neighbour]
+        if source != target:
+            successors.setdefault(source, []).append(target)
+            in_degree[target] += 1
+
+    component_depths = dict.fromkeys(in_degree, 0)
+    queue = deque(source for source, degree in in_degree.items() if degree == 0)
+    while queue:
+        source = queue.popleft()
+        for target in successors.get(source, ()):
+            if component_depths[source] + 1 > component_depths[target]:
+                component_depths[target] = component_depths[source] + 1
+            in_degree[target] -= 1
+            if in_degree[target] == 0:
+                queue.append(target)
+
+    for code in depths:
+        depths[code] = component_depths[component_of[code]]
+
+
+class RelativesMemo:
+    """
+    Memoizes the relatives of the nodes met during a batch of queries, so that the queries share their traversal work.
+
+    The row of a node (its relatives and their depths) is computed from the rows of its direct neighbours, which are
+    themselves computed once and kept for the next queries: on a hierarchy where many entities share the same ancestors,
+    each ancestor cone is walked only once for the whole batch. The rows of the nodes in a cycle, and of the nodes
+    leading to a cycle which was not flagged, are computed with a plain breadth-first search. The results are the same
+    as `collect_ancestors` and `collect_descendants`, except for the longest depths around a cycle which was not
+    flagged.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        depth (str, optional): 'shortest' or 'longest', defaults to 'shortest'.
+
+    Raises:
+        ValueError: If `depth` is not one of the supported modes.
+    """
+
+    def __init__(self, index, depth='shortest'):
+        if depth not in DEPTH_MODES:
+            raise ValueError(f"Unknown depth mode '{depth}', expected one of: {', '.join(DEPTH_MODES)}")
+        self.index = index
+        self.depth = depth
+        self._ancestor_rows = {}
+        self._descendant_rows = {}
+
+    def ancestors(self, start):
+        """
+        Memoized equivalent of `collect_ancestors(self.index, start, self.depth)`.
+        """
+        index = self.index
+        if index.closure is not None and index.closure.depth == self.depth:
+            return index.closure.ancestors_of(start)
+        depths = {start: 0}
+        depths.update(self._row(start, index.parents_of, self._ancestor_rows))
+        return depths
+
+    def descendants(self, start):
+        """
+        Memoized equivalent of `collect_descendants(self.index, start, self.depth)`.
+        """
+        depths = {start: 0}
+        row = self._row(start, self.index.children_of, self._descendant_rows)
+        depths.update((code, -node_depth) for code, node_depth in row.items())
+        return depths
+
+    def _row(self, start, neighbours_of, rows):
+        """
+        Returns the relatives of `start` (without itself) and their depths, computing the missing rows depth-first.
+        """
+        row = rows.get(start)
+        if row is not None:
+            return row
+
+        in_cycle = self.index.in_cycle
+        component = self.index.component
+        pick = min if self.depth == 'shortest' else max
+
+        def search(code):
+            row = _breadth_first(neighbours_of, component, code, self.depth)
+            del row[code]
+            return row
+
+        if in_cycle[start]:
+            rows[start] = search(start)
+            return rows[start]
+
+        def explore(code):
+            neighbours = neighbours_of(code)
+            for neighbour in neighbours:
+                if in_cycle[neighbour] and neighbour not in rows:
+                    rows[neighbour] = search(neighbour)
+            return code, neighbours, iter(neighbours)
+
+        stack = [explore(start)]
+        on_stack = {start}
+        while stack:
+            code, neighbours, pending = stack[-1]
+            for neighbour in pending:
+                if neighbour in rows:
+                    continue
+                if neighbour in on_stack:
+                    # Cycle which was not flagged: the nodes on the stack all lead to it.
+                    for stacked_code, _, _ in stack:
+                        rows[stacked_code] = search(stacked_code)
+                    return rows[start]
+                stack.append(explore(neighbour))
+                on_stack.add(neighbour)
+                break
+            else:
+                row = {}
+                for neighbour in neighbours:
+                    row[neighbour] = pick(row.get(neighbour, 1), 1)
+                    for relative, relative_depth in rows[neighbour].items():
+                        current = row.get(relative)
+                        row[relative] = relative_depth + 1 if current is None else pick(current, relative_depth + 1)
+                row.pop(code, None)
+                rows[code] = row
+                stack.pop()
+                on_stack.discard(code)
+        return rows[start]
+
+
+class AncestorClosure:
+    """
+    Precomputed ancestor closure of an ontology, stored as CSR-style NumPy arrays.
+
+    The ancestors of the node `code` are `ancestors[offsets[code]:offsets[code + 1]]`, at the depths found at the same
+    positions in `depths`, in the order `collect_ancestors` visits them. The node itself is not stored in its row.
+
+    Attributes:
+        depth (str): The depth mode ('shortest' or 'longest') the closure was computed for.
+        offsets (numpy.ndarray): Offsets of each node's row, of length `len(index) + 1`.
+        ancestors (numpy.ndarray): Codes of the ancestors of every node, concatenated.
+        depths (numpy.ndarray): Depths of the ancestors, using the smallest unsigned integer type able to hold them.
+        build_seconds (float): Time spent building the closure.
+    """
+
+    def __init__(self, depth, offsets, ancestors, depths, build_seconds=0.0):
+        self.depth = depth
+        self.offsets = offsets
+        self.ancestors = ancestors
+        self.depths = depths
+        self.build_seconds = build_seconds
+
+    @classmethod
+    def build(cls, index, depth='shortest'):
+        """
+        Computes the closure by running `collect_ancestors` once from every node of the index.
+
+        Args:
+            index (OntologyIndex): The index of the ontology, whose `closure` must not be set.
+            depth (str, optional): 'shortest' or 'longest', defaults to 'shortest'.
+
+        Returns:
+            AncestorClosure: The closure of the ontology.
+        """
+        started = time.perf_counter()
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        ancestors = array('i')
+        depths = array('i')
+        for code in range(len(index)):
+            row = collect_ancestors(index, code, depth)
+            del row[code]
+            ancestors.extend(row.keys())
+            depths.extend(row.values())
+            offsets[code + 1] = len(ancestors)
+
+        depths = np.asarray(depths, dtype=np.int32)
+        max_depth = int(depths.max()) if len(depths) else 0
+        return cls(depth,
+                   offsets,
+                   np.asarray(ancestors, dtype=np.int32),
+                   depths.astype(np.min_scalar_type(max_depth)),
+                   time.perf_counter() - started)
+
+    @property
+    def nbytes(self):
+        """
+        int: Memory used by the arrays of the closure, in bytes.
+        """
+        return self.offsets.nbytes + self.ancestors.nbytes + self.depths.nbytes
+
+    def __len__(self):
+        return len(self.ancestors)
+
+    def ancestors_of(self, code):
+        """
+        Answers `collect_ancestors` for a node from its row of the closure.
+
+        Args:
+            code (int): The code of the node.
+
+        Returns:
+            dict: The same dictionary as `collect_ancestors`.
+        """
+        start, end = self.offsets[code], self.offsets[code + 1]
+        depths = {code: 0}
+        depths.update(zip(self.ancestors[start:end].tolist(), self.depths[start:end].tolist()))
+        return depths
+
+    def summary(self):
+        """
+        Returns a short report on the size of the closure and the time spent building it.
+
+        Returns:
+            str: The report.
+        """
+        return (f"Ancestor closure ({self.depth}): {len(self)} relations, {self.nbytes / 2 ** 20:.2f} MiB, "
+                f"built in {self.build_seconds:.2f}s")
@@ -0,0 +1,168 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the buckets of the duration histograms, in seconds
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0, 30.0, 60.0)
+# Upper bounds of the buckets of the histograms of counts (e.g. nodes visited by a traversal)
+COUNT_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+class Histogram:
+    """
+    Histogram of observed values with one label, rendered in the Prometheus text format.
+
+    As in Prometheus, the buckets are cumulative: the bucket `le` counts the observations lower than or equal to it,
+    and the `+Inf` bucket counts them all. The observations may come from several threads.
+
+    Args:
+        name (str): Name of the metric.
+        documentation (str): Description of the metric, rendered as its HELP line.
+        label (str): Name of the label distinguishing the series of the metric (e.g. 'stage').
+        buckets (tuple): Increasing upper bounds of the buckets.
+    """
+
+    def __init__(self, name, documentation, label, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        # Per label value: the number of observations in each bucket (not cumulated) and in +Inf, and their sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value):
+        """
+        Records an observation.
+
+        Args:
+            value (float): The observed value.
+            label_value (str): The value of the label of the series the observation belongs to.
+        """
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][position] += 1
+            series[1] += value
+
+    def render(self):
+        """
+        Renders the histogram in the Prometheus text format.
+
+        Returns:
+            list: The lines of the HELP and TYPE comments, then the buckets, sum and count of each series.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((label_value, list(counts), total) for label_value, (counts, total) in self._series.items())
+        for label_value, counts, total in series:
+            label = f'{self.label}="{label_value}"'
+            cumulated = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulated += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulated}')
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulated}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('ontology_stage_seconds', 'Duration of the stages of the loads and queries of the ontologies.',
+                          'stage', DURATION_BUCKETS)
+STAGE_ITEMS = Histogram('ontology_stage_items',
+                        'Number of items processed by the stages (rows parsed, nodes visited, entities selected).',
+                        'stage', COUNT_BUCKETS)
+
+
+def render_metric(name, documentation, kind, value):
+    """
+    Renders a metric with a single value (e.g. a counter or a gauge) in the Prometheus text format.
+
+    Returns:
+        list: The lines of the HELP and TYPE comments, then the value.
+    """
+    return [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+
+def render_metrics(*extra):
+    """
+    Renders the stage histograms, followed by other metrics, as the body of a `/metrics` response.
+
+    Args:
+        *extra (list): Lines of other metrics, as returned by `render_metric`.
+
+    Returns:
+        str: The metrics in the Prometheus text format.
+    """
+    lines = STAGE_SECONDS.render() + STAGE_ITEMS.render()
+    for metric in extra:
+        lines.extend(metric)
+    return '\n'.join(lines) + '\n'
+
+
+class StageTimings:
+    """
+    Breakdown of the duration of an operation (the load of an ontology, a query...) into named stages.
+
+    Each stage is also observed in the histograms exported by `/metrics`, so that the functions which time their
+    stages feed the metrics even when nobody asks for their breakdown. A stage run several times in the same operation
+    (e.g. the traversals of a batch) accumulates its durations.
+
+    Attributes:
+        seconds (dict): Total duration of each stage, in seconds, in the order the stages were first run.
+        items (dict): Total number of items processed by the stages which count them.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.items = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the block of a `with` statement as a stage.
+
+        Args:
+            name (str): The name of the stage, a token without spaces (it is used in the Server-Timing header).
+        """
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        """
+        Records the duration of a stage.
+        """
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, name)
+
+    def count(self, name, items):
+        """
+        Records the number of items processed by a stage.
+        """
+        self.items[name] = self.items.get(name, 0) + items
+        STAGE_ITEMS.observe(items, name)
+
+    def server_timing(self):
+        """
+        Returns the breakdown as the value of a Server-Timing header, with the durations in milliseconds.
+        """
+        return ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds in self.seconds.items())
+
+    def report(self):
+        """
+        Returns the breakdown as a table, one stage per line, with the number of items processed if it is counted.
+        """
+        lines = []
+        for name, seconds in self.seconds.items():
+            line = f'{name:<20} {seconds * 1000:>10.3f} ms'
+            if name in self.items:
+                line += f'  ({self.items[name]} items)'
+            lines.append(line)
+        lines.append(f"{'total':<20} {sum(self.seconds.values()) * 1000:>10.3f} ms")
+        return '\n'.join(lines)
@@ -0,0 +1,146 @@
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import cached_property
+
+import numpy as np
+
+from ontology_index import csr_from_edges
+
+# Length of the character n-grams compared by the fuzzy search
+NGRAM_SIZE = 3
+# Minimum similarity (Dice coefficient of the n-grams) of a fuzzy suggestion
+MIN_SIMILARITY = 0.3
+
+
+def normalize_label(text):
+    """
+    Normalizes a label for the search: Unicode compatibility form, case folded and whitespace collapsed.
+
+    Args:
+        text (str): The label, or a query.
+
+    Returns:
+        str: The normalized text, e.g. 'dermatoses' for '  Dermatoses' or 'DERMATOSES'.
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+def ngrams(text, size=NGRAM_SIZE):
+    """
+    Returns the set of the character n-grams of a normalized text, padded with a space on each side so that the
+    beginning and the end of the text are n-grams of their own.
+    """
+    padded = f' {text} '
+    return {padded[start:start + size] for start in range(max(len(padded) - size + 1, 1))}
+
+
+class LabelSearch:
+    """
+    Search index of the labels of an ontology, for the queries which do not exactly match a 'Preferred Label'.
+
+    The labels are normalized by `normalize_label` and sorted, so that a bisection finds both the labels equal to a
+    normalized query and the labels starting with it (autocompletion), in O(log(n)) plus the number of labels
+    returned. The fuzzy search compares the character n-grams of the query with the ones of the labels, through an
+    inverted index (the labels containing each n-gram) built the first time it is used.
+
+    Args:
+        keys (sequence): The normalized labels, sorted: a list, or the `StringTable` of a snapshot.
+        codes (numpy.ndarray): The code of the entity of each key.
+    """
+
+    def __init__(self, keys, codes):
+        self.keys = keys
+        self.codes = codes
+
+    @classmethod
+    def from_labels(cls, labels):
+        """
+        Builds the search index of the labels of an ontology.
+
+        Args:
+            labels (sequence): The labels, indexed by code. The None labels (removed entities) are not indexed.
+
+        Returns:
+            LabelSearch: The search index.
+        """
+        pairs = sorted((normalize_label(label), code) for code, label in enumerate(labels) if label is not None)
+        return cls([key for key, _ in pairs], np.fromiter((code for _, code in pairs), dtype=np.int64, count=len(pairs)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def matches(self, query):
+        """
+        Returns the codes of the labels equal to a query, once both are normalized.
+
+        Args:
+            query (str): The query.
+
+        Returns:
+            list: The codes, in increasing order.
+        """
+        key = normalize_label(query)
+        return self.codes[bisect_left(self.keys, key):bisect_right(self.keys, key)].tolist()
+
+    def complete(self, prefix, limit=10):
+        """
+        Returns the codes of the labels starting with a prefix, once both are normalized.
+
+        Args:
+            prefix (str): The beginning of a label, as typed.
+            limit (int, optional): Maximum number of codes returned, defaults to 10.
+
+        Returns:
+            list: The codes, in the order of the normalized labels.
+        """
+        prefix = normalize_label(prefix)
+        start = bisect_left(self.keys, prefix)
+        end = start
+        while end < len(self.keys) and end - start < limit and self.keys[end].startswith(prefix):
+            end += 1
+        return self.codes[start:end].tolist()
+
+    @cached_property
+    def _inverted_index(self):
+        # CSR arrays of the keys containing each n-gram, and the number of distinct n-grams of each key
+        gram_ids = {}
+        key_grams = array('q')
+        gram_counts = array('q')
+        for key in self.keys:
+            grams = ngrams(key)
+            gram_counts.append(len(grams))
+            key_grams.extend([gram_ids.setdefault(gram, len(gram_ids)) for gram in grams])
+        gram_counts = np.frombuffer(gram_counts, dtype=np.int64)
+        keys = np.repeat(np.arange(len(self.keys), dtype=np.int32), gram_counts)
+        offsets, positions = csr_from_edges(np.frombuffer(key_grams, dtype=np.int64), keys, len(gram_ids))
+        return gram_ids, offsets, positions, gram_counts
+
+    def suggest(self, query, limit=10, min_similarity=MIN_SIMILARITY):
+        """
+        Returns the labels the most similar to a query, for instance to correct its spelling.
+
+        The similarity of a label is the Dice coefficient of its n-grams and the ones of the query (2 * shared n-grams
+        / total n-grams), once both are normalized. Only the labels sharing at least one n-gram with the query are
+        compared.
+
+        Args:
+            query (str): The query.
+            limit (int, optional): Maximum number of suggestions, defaults to 10.
+            min_similarity (float, optional): Minimum similarity of a suggestion, defaults to `MIN_SIMILARITY`.
+
+        Returns:
+            list: (code, similarity) tuples, the most similar first (then in the order of the normalized labels).
+        """
+        gram_ids, offsets, positions, gram_counts = self._inverted_index
+        grams = ngrams(normalize_label(query))
+        found = [gram_ids[gram] for gram in grams if gram in gram_ids]
+        if not found or limit <= 0:
+            return []
+        candidates, shared = np.unique(np.concatenate([positions[offsets[gram]:offsets[gram + 1]] for gram in found]),
+                                       return_counts=True)
+        similarities = 2 * shared / (len(grams) + gram_counts[candidates])
+        kept = np.flatnonzero(similarities >= min_similarity)
+        kept = kept[np.argsort(-similarities[kept], kind='stable')[:limit]]
+        return [(code, similarity) for code, similarity in zip(self.codes[candidates[kept]].tolist(),
+                                                             similarities[kept].tolist())]
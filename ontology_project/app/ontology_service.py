@@ -0,0 +1,555 @@
+import json
+import os
+import sys
+import threading
+
+from ontology_cache import ResultCache
+from ontology_csv import read_ontology_csv
+from ontology_diff import apply_diff
+from ontology_helper import get_ontology, select_first_dense_entities, select_first_entities
+from ontology_index import RelativesMemo
+from ontology_metrics import StageTimings
+from ontology_search import LabelSearch
+from ontology_snapshot import is_snapshot_fresh, load_snapshot, snapshot_path
+
+DEFAULT_DIR_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'onto_x.csv')
+# Depth mode ('shortest' or 'longest') for which the API precomputes the ancestor closure, none if unset
+CLOSURE_DEPTH = os.environ.get('ONTOLOGY_CLOSURE') or None
+# Seconds between two checks of the CSV files of the loaded ontologies, which are reloaded when they change (never if
+# unset or 0)
+RELOAD_INTERVAL = float(os.environ.get('ONTOLOGY_RELOAD_INTERVAL') or 0)
+# Memory budget of the cache of query results, in bytes (0 disables it)
+RESULT_CACHE_BYTES = int(os.environ.get('ONTOLOGY_CACHE_BYTES') or 64 * 2 ** 20)
+# Number of threads computing the queries of the API
+QUERY_THREADS = int(os.environ.get('ONTOLOGY_QUERY_THREADS') or 4)
+# Number of queries the API computes or queues at once, beyond which it answers 503
+MAX_PENDING_QUERIES = int(os.environ.get('ONTOLOGY_MAX_PENDING_QUERIES') or 64)
+# Seconds after which the API gives up on a query and answers 504 (never if 0)
+QUERY_TIMEOUT = float(os.environ.get('ONTOLOGY_QUERY_TIMEOUT') or 30)
+# Whether the API reports the duration of the stages of each query in a Server-Timing header
+SERVER_TIMING = (os.environ.get('ONTOLOGY_SERVER_TIMING') or '0') != '0'
+# Token the callers of the admin endpoints must send as 'Authorization: Bearer <token>' (the endpoints are disabled
+# if unset)
+ADMIN_TOKEN = os.environ.get('ONTOLOGY_ADMIN_TOKEN') or None
+# CSV files the API may load besides the default one, separated by os.pathsep (e.g. /data/a.csv:/data/b.csv)
+SERVED_DIR_CSVS = {os.path.realpath(path)
+                   for path in [DEFAULT_DIR_CSV, *os.environ.get('ONTOLOGY_CSV_FILES', '').split(os.pathsep)] if path}
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+# CSV files whose index is being rebuilt
+_reloading = set()
+result_cache = ResultCache(RESULT_CACHE_BYTES)
+# Serializes the construction of the search indexes of the labels
+_label_search_lock = threading.Lock()
+
+
+def load_csv_index(dir_csv, timings=None):
+    """
+    Builds the index of the ontology stored in a CSV file, by streaming and preprocessing it (see `read_ontology_csv`).
+
+    The file is never loaded in a DataFrame, so that pandas is not imported and the memory used is bounded by the
+    index.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        timings (StageTimings, optional): Records the duration of the stages of the load. Defaults to None.
+
+    Returns:
+        OntologyIndex: The index of the ontology.
+    """
+    return read_ontology_csv(dir_csv, timings=timings)
+
+
+def source_version(dir_csv):
+    """
+    Identifies the current content of a CSV file from its modification time and size.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+
+    Returns:
+        str: The version of the file, which changes whenever the file is rewritten.
+
+    Raises:
+        OSError: If the file does not exist.
+    """
+    stat = os.stat(dir_csv)
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+
+def _load_index(dir_csv, closure=None, timings=None):
+    """
+    Loads the index of a CSV file (from its snapshot if it is fresh) and tags it with the version of the file.
+    """
+    if timings is None:
+        timings = StageTimings()
+    # Read before the file itself, so that a file rewritten during the load is seen as changed by the next check
+    version = source_version(dir_csv)
+    index = None
+    if is_snapshot_fresh(snapshot_path(dir_csv), dir_csv):
+        try:
+            with timings.stage('snapshot_load'):
+                index = load_snapshot(snapshot_path(dir_csv))
+        except ValueError as error:
+            # e.g. a snapshot compiled by a previous version, which must be compiled again
+            print(f'{error} Loading the CSV file instead.', file=sys.stderr)
+    if index is None:
+        index = load_csv_index(dir_csv, timings)
+        # Built now rather than by the first query or diff, which would otherwise take ~1s longer at 1M entities
+        with timings.stage('lookups'):
+            index.id_to_code, index.label_to_code
+    index.version = version
+    if closure is not None:
+        with timings.stage('closure'):
+            summary = index.precompute_closure(closure).summary()
+        print(summary, file=sys.stderr)
+    return index
+
+
+def served_dir_csv(dir_csv):
+    """
+    Checks that the API may serve a CSV file, and returns its canonical path.
+
+    The indexes are kept for the lifetime of the process, so the API only loads the files it is configured for
+    (`SERVED_DIR_CSVS`) rather than any path sent by a client. The path is normalized, so that two spellings of the
+    same file share a single index.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology, as sent by a client.
+
+    Returns:
+        str: The real path of the file, or None if the API does not serve it.
+    """
+    path = os.path.realpath(dir_csv)
+    return path if path in SERVED_DIR_CSVS else None
+
+
+def get_ontology_index(dir_csv, closure=None, timings=None):
+    """
+    Returns the index of the ontology stored in a CSV file, loading and preprocessing the file only the first time.
+
+    If a snapshot compiled from the CSV file (see `write_snapshot`) exists and is newer than it, the index is loaded
+    from the snapshot instead. While the index is being reloaded (see `reload_ontology_index`), the previous version
+    keeps being returned.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        closure (str, optional): Depth mode for which the ancestor closure of the index is precomputed, if not done
+                                 yet. Its size and build time are reported on stderr. Defaults to None (no closure).
+        timings (StageTimings, optional): Records the duration of the stages of the load, if the index is loaded (or
+                                          its closure precomputed) by this call. Defaults to None.
+
+    Returns:
+        OntologyIndex: The index shared by every query made on this CSV file.
+    """
+    if timings is None:
+        timings = StageTimings()
+    index = _indexes.get(dir_csv)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(dir_csv)
+            if index is None:
+                index = _indexes[dir_csv] = _load_index(dir_csv, timings=timings)
+    if closure is not None and (index.closure is None or index.closure.depth != closure):
+        with _indexes_lock:
+            if index.closure is None or index.closure.depth != closure:
+                with timings.stage('closure'):
+                    summary = index.precompute_closure(closure).summary()
+                print(summary, file=sys.stderr)
+    return index
+
+
+def get_loaded_ontology_index(dir_csv, closure=None):
+    """
+    Returns the index of the ontology stored in a CSV file if it is already loaded, without ever loading it.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        closure (str, optional): Depth mode of the ancestor closure the index must have. Defaults to None (any).
+
+    Returns:
+        OntologyIndex: The index returned by `get_ontology_index`, or None if it would have to be loaded (or its
+                       closure precomputed) first.
+    """
+    index = _indexes.get(dir_csv)
+    if index is None or (closure is not None and (index.closure is None or index.closure.depth != closure)):
+        return None
+    return index
+
+
+def _invalidate_results(dir_csv):
+    # The results of the previous versions can no longer be hit, as the version is part of the key: they are dropped
+    # to free their memory
+    current_version = _indexes[dir_csv].version
+    result_cache.invalidate(lambda key: key[0] == dir_csv and key[1] != current_version)
+
+
+def _reserve_reload(dir_csv):
+    """
+    Marks a CSV file as being reloaded, unless it already is.
+
+    Returns:
+        bool: True if the caller is now in charge of the reload.
+    """
+    with _indexes_lock:
+        if dir_csv in _reloading:
+            return False
+        _reloading.add(dir_csv)
+        return True
+
+
+def _reload(dir_csv, closure=None):
+    """
+    Rebuilds the index of a CSV file reserved with `_reserve_reload`, and swaps it in place of the current one.
+    """
+    try:
+        current = _indexes.get(dir_csv)
+        if closure is None and current is not None and current.closure is not None:
+            closure = current.closure.depth
+        index = _load_index(dir_csv, closure)
+        with _indexes_lock:
+            _indexes[dir_csv] = index
+        _invalidate_results(dir_csv)
+        print(f'Ontology {dir_csv} reloaded (version {index.version})', file=sys.stderr)
+        return index
+    finally:
+        with _indexes_lock:
+            _reloading.discard(dir_csv)
+
+
+def reload_ontology_index(dir_csv, closure=None):
+    """
+    Rebuilds the index of a CSV file and swaps it in place of the current one.
+
+    The new index is built (preprocessing and cycle detection included) without holding any lock, so that the queries
+    keep being answered by the current index in the meantime. The swap itself is a single assignment: the queries
+    started before it finish against the index they already hold, the next ones get the new index.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        closure (str, optional): Depth mode for which the ancestor closure of the new index is precomputed. Defaults
+                                 to None (the depth mode of the current closure, if any).
+
+    Returns:
+        OntologyIndex: The new index, or None if the file is already being reloaded.
+    """
+    if not _reserve_reload(dir_csv):
+        return None
+    return _reload(dir_csv, closure)
+
+
+def _reload_in_background(dir_csv, closure):
+    try:
+        _reload(dir_csv, closure)
+    except Exception as error:
+        # The current index stays in place, and the next change of the file triggers another attempt
+        print(f'Reload of the ontology {dir_csv} failed: {error!r}', file=sys.stderr)
+
+
+def start_reload(dir_csv, closure=None):
+    """
+    Reloads the index of a CSV file in a background thread (see `reload_ontology_index`).
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        closure (str, optional): Depth mode for which the ancestor closure of the new index is precomputed.
+
+    Returns:
+        bool: True if the reload was started, False if the file is already being reloaded.
+    """
+    if not _reserve_reload(dir_csv):
+        return False
+    threading.Thread(target=_reload_in_background, args=(dir_csv, closure), name='ontology-reload', daemon=True).start()
+    return True
+
+
+def apply_ontology_diff(dir_csv, added=(), removed=(), changed=()):
+    """
+    Applies a diff to the index of a CSV file (see `apply_diff`), and swaps the updated index in place of the current one.
+
+    Like a reload, the swap does not disturb the queries running on the current index. The CSV file itself is not
+    modified: the diff is lost at the next reload, which is expected to bring a release of the file including it.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        added (iterable, optional): The new rows, as dictionaries with 'Class ID', 'Preferred Label' and 'Parents'.
+        removed (iterable, optional): The 'Class ID' of the removed rows.
+        changed (iterable, optional): The new version of the changed rows, as dictionaries like `added`.
+
+    Returns:
+        OntologyIndex: The updated index, or None if the file is being reloaded.
+
+    Raises:
+        ValueError: If the diff does not apply to the current index.
+    """
+    get_ontology_index(dir_csv)
+    if not _reserve_reload(dir_csv):
+        return None
+    try:
+        index = apply_diff(_indexes[dir_csv], added, removed, changed)
+        with _indexes_lock:
+            _indexes[dir_csv] = index
+        _invalidate_results(dir_csv)
+        return index
+    finally:
+        with _indexes_lock:
+            _reloading.discard(dir_csv)
+
+
+class OntologyWatcher(threading.Thread):
+    """
+    Background thread reloading the loaded ontologies whose CSV file changed.
+
+    Every `interval` seconds, the version of the CSV file of each loaded index is compared to the version of the index,
+    and the index is reloaded if they differ. The CSV files should be replaced atomically (written next to their final
+    path, then renamed): a file caught in the middle of a write is reloaded again once its version settles.
+    """
+
+    def __init__(self, interval, closure=None):
+        super().__init__(name='ontology-watcher', daemon=True)
+        self.interval = interval
+        self.closure = closure
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            for dir_csv, index in list(_indexes.items()):
+                try:
+                    # The diffs applied to the index extend its version after a '+', the file is unchanged
+                    changed = source_version(dir_csv) != index.version.partition('+')[0]
+                except OSError:
+                    continue
+                if changed and _reserve_reload(dir_csv):
+                    _reload_in_background(dir_csv, self.closure)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def get_label_search(index, timings=None):
+    """
+    Returns the search index of the labels of an index, building it the first time.
+
+    An index loaded from a snapshot comes with its search index, shared by the processes serving the snapshot. The
+    other ones (loaded from a CSV file, or updated by a diff) build their own the first time a label is searched.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        timings (StageTimings, optional): Records the duration of the construction ('search_build'), if it happens
+                                          in this call. Defaults to None.
+
+    Returns:
+        LabelSearch: The search index, shared by every search on this version of the ontology.
+    """
+    if timings is None:
+        timings = StageTimings()
+    search = index.label_search
+    if search is None:
+        with _label_search_lock:
+            search = index.label_search
+            if search is None:
+                with timings.stage('search_build'):
+                    search = index.label_search = LabelSearch.from_labels(index.labels)
+    return search
+
+
+def resolve_label(index, query, timings=None):
+    """
+    Returns the 'Preferred Label' of the entity designated by a query.
+
+    The query may be the exact label of the entity, its 'Class ID', or its label up to the case and whitespace (see
+    `normalize_label`) as long as no other label normalizes the same way.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        query (str): The label or Class ID queried.
+        timings (StageTimings, optional): Records the construction of the search index of the labels ('search_build'),
+                                          if a query neither a label nor a Class ID needs it first. Defaults to None.
+
+    Returns:
+        str: The label of the entity, or None if the query designates no entity (or several ones, see
+             `unresolved_label_message`).
+    """
+    if query in index:
+        return query
+    code = index.id_to_code.get(query)
+    if code is None:
+        codes = get_label_search(index, timings).matches(query)
+        if len(codes) != 1:
+            return None
+        code = codes[0]
+    return index.labels[code]
+
+
+def unresolved_label_message(index, query, timings=None):
+    """
+    Explains why `resolve_label` designates no entity for a query.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        query (str): The label or Class ID queried.
+        timings (StageTimings, optional): Records the construction of the search index of the labels, as in
+                                          `resolve_label`. Defaults to None.
+
+    Returns:
+        str: The message for the user, listing the matching labels if the query matches several ones.
+    """
+    codes = get_label_search(index, timings).matches(query)
+    if len(codes) > 1:
+        labels = ', '.join(repr(index.labels[code]) for code in codes)
+        return f"The entity '{query}' is ambiguous, it may designate {labels}. Please, use one of these labels."
+    return f"The entity '{query}' is not present in the CSV. Please, check the spelling of the label."
+
+
+def search_ontology(index, query, limit=10, fuzzy=False, timings=None):
+    """
+    Searches the entities of the ontology for a query, typed by a user.
+
+    The result holds the entity designated by the query (see `resolve_label`), the entities whose label starts with
+    the query (autocompletion), and the entities whose label is similar to it (see `LabelSearch.suggest`). The
+    similar entities are only searched with `fuzzy`, or when no other entity is found.
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        query (str): The query.
+        limit (int, optional): Maximum number of completions and of suggestions, defaults to 10.
+        fuzzy (bool, optional): Whether the similar entities are always searched, defaults to False.
+        timings (StageTimings, optional): Records the duration of the stages of the search. Defaults to None.
+
+    Returns:
+        dict: The 'match' (an entity or None), 'completions' and 'suggestions' (lists of entities), each entity being
+              a dictionary with its 'label' and 'class_id' (and the 'similarity' of the suggestions).
+    """
+    if timings is None:
+        timings = StageTimings()
+    search = get_label_search(index, timings)
+    entity = lambda code: {'label': index.labels[code], 'class_id': index.class_ids[code]}
+    with timings.stage('search_match'):
+        label = resolve_label(index, query, timings)
+        match = entity(index.code_of(label)) if label is not None else None
+    with timings.stage('search_complete'):
+        completions = [entity(code) for code in search.complete(query, limit)]
+    suggestions = []
+    if fuzzy or (match is None and not completions):
+        with timings.stage('search_suggest'):
+            suggestions = [dict(entity(code), similarity=round(similarity, 3))
+                           for code, similarity in search.suggest(query, limit)]
+    return {'match': match, 'completions': completions, 'suggestions': suggestions}
+
+
+def cached_query_result(dir_csv, index, label, n=9999, depth='shortest', direction='ancestors', dense=False,
+                        timings=None):
+    """
+    Returns the result of a query if it is in the result cache, without computing it.
+
+    The arguments are those of `query_ontology_index`.
+
+    Returns:
+        dict: The cached result, which must not be modified, or None if it is not cached.
+    """
+    if timings is None:
+        timings = StageTimings()
+    with timings.stage('cache_lookup'):
+        return result_cache.get((dir_csv, index.version, label, depth, direction, n, dense))
+
+
+def compute_query_result(dir_csv, index, label, n=9999, depth='shortest', direction='ancestors', dense=False,
+                         timings=None):
+    """
+    Computes the result of a query and caches it, without looking it up in the result cache first.
+
+    The arguments are those of `query_ontology_index`.
+
+    Returns:
+        dict: The result, which is shared with the cache and must not be modified.
+    """
+    if timings is None:
+        timings = StageTimings()
+    # The relatives of a same level are ranked by code, taken from the traversal rather than looked up by label
+    codes = {}
+    with timings.stage('traversal'):
+        onto_dict = get_ontology(label, index, depth=depth, direction=direction, codes=codes)
+    timings.count('traversal', len(onto_dict))
+    with timings.stage('select'):
+        if dense:
+            result = select_first_dense_entities(index, onto_dict, n, codes.__getitem__)
+        else:
+            result = select_first_entities(onto_dict, n, codes.__getitem__)
+    timings.count('select', len(result))
+    result_cache.put((dir_csv, index.version, label, depth, direction, n, dense), result)
+    return result
+
+
+def query_ontology_index(dir_csv, index, label, n=9999, depth='shortest', direction='ancestors', dense=False,
+                         timings=None):
+    """
+    Answers a query on a label of the ontology, through the result cache.
+
+    By default, the result only holds the relatives of `label` (itself included), sorted by level. With `dense`, it
+    holds every label of the ontology, 0 for the entities unrelated to `label`, as `/query-ontology/` used to return.
+    In both cases, only the first `n` entries are selected, without sorting the whole result. The result is cached
+    under the version of the index, so that a hit skips the traversal and the selection, and that the results of a
+    reloaded ontology are never served from its previous version.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+        index (OntologyIndex): The index of the ontology, as returned by `get_ontology_index`.
+        label (str): The label of the entity, which must be in the index.
+        n (int, optional): Maximum number of entities returned, defaults to 9999.
+        depth (str, optional): 'shortest' or 'longest', defaults to 'shortest'.
+        direction (str, optional): 'ancestors', 'descendants' or 'both', defaults to 'ancestors'.
+        dense (bool, optional): Whether the entities unrelated to `label` are included, defaults to False.
+        timings (StageTimings, optional): Records the duration of the cache lookup ('cache_lookup') and, on a miss, of
+                                          the traversal ('traversal', with the number of nodes visited) and of the
+                                          selection of the first entities ('select'). Defaults to None.
+
+    Returns:
+        dict: The first `n` entities of the sorted result. It is shared with the cache and must not be modified.
+    """
+    if timings is None:
+        timings = StageTimings()
+    result = cached_query_result(dir_csv, index, label, n, depth, direction, dense, timings)
+    if result is None:
+        result = compute_query_result(dir_csv, index, label, n, depth, direction, dense, timings)
+    return result
+
+
+def iter_batch_results(index, labels, n=9999, depth='shortest', direction='ancestors', timings=None):
+    """
+    Queries the ontology for each label of a batch and yields the results as NDJSON lines.
+
+    The queries share a `RelativesMemo`, so that the ancestors (or descendants) common to several labels are explored
+    only once. Each line holds the sorted relatives of one label (without the entities unrelated to it), or an error
+    message if the label is not in the ontology. As in the single queries, an entity may also be designated by its
+    Class ID or by its label up to the case and whitespace (see `resolve_label`).
+
+    Args:
+        index (OntologyIndex): The index of the ontology.
+        labels (iterable): The labels to query, consumed lazily.
+        n (int, optional): Maximum number of relatives kept for each label, defaults to 9999.
+        depth (str, optional): 'shortest' or 'longest', defaults to 'shortest'.
+        direction (str, optional): 'ancestors', 'descendants' or 'both', defaults to 'ancestors'.
+        timings (StageTimings, optional): Accumulates the duration of the traversals, selections and serializations of
+                                          the labels. Defaults to None.
+
+    Yields:
+        str: A JSON object followed by a newline, for each label.
+    """
+    if timings is None:
+        timings = StageTimings()
+    memo = RelativesMemo(index, depth)
+    for label in labels:
+        resolved = resolve_label(index, label, timings)
+        if resolved is not None:
+            codes = {}
+            with timings.stage('traversal'):
+                onto_dict = get_ontology(resolved, index, direction=direction, memo=memo, codes=codes)
+            timings.count('traversal', len(onto_dict))
+            with timings.stage('select'):
+                result = {'label': label, 'ontology': select_first_entities(onto_dict, n, codes.__getitem__)}
+        else:
+            result = {'label': label, 'error': unresolved_label_message(index, label, timings)}
+        with timings.stage('serialize'):
+            line = json.dumps(result) + '\n'
+        yield line
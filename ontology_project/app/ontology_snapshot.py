@@ -0,0 +1,296 @@
+import json
+import os
+import tempfile
+import zlib
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from ontology_index import AncestorClosure, OntologyIndex
+from ontology_search import LabelSearch
+
+SNAPSHOT_MAGIC = b'ONTOSNAP'
+SNAPSHOT_VERSION = 3
+# Every array starts on a multiple of this many bytes, so that the memory-mapped views are aligned
+ALIGNMENT = 64
+
+
+def snapshot_path(dir_csv):
+    """
+    Returns the path of the snapshot compiled from a CSV file.
+
+    Args:
+        dir_csv (str): Path to the CSV file containing the ontology.
+
+    Returns:
+        str: The path of the snapshot, next to the CSV file.
+    """
+    return f'{dir_csv}.snapshot'
+
+
+def is_snapshot_fresh(path, dir_csv):
+    """
+    Checks if a snapshot exists and is newer than the CSV file it was compiled from.
+
+    Args:
+        path (str): Path to the snapshot.
+        dir_csv (str): Path to the CSV file containing the ontology.
+
+    Returns:
+        bool: True if the snapshot can be loaded instead of the CSV file.
+    """
+    try:
+        return os.path.getmtime(path) >= os.path.getmtime(dir_csv)
+    except OSError:
+        return False
+
+
+class StringTable(Sequence):
+    """
+    Read-only sequence of strings stored in a single UTF-8 buffer, each string being decoded when it is accessed.
+
+    The buffer and the offsets of the strings are meant to be views of a memory-mapped snapshot, so that the processes
+    serving the same snapshot share the table instead of each holding its own list of Python strings.
+
+    Args:
+        data (numpy.ndarray): The UTF-8 bytes of the strings, concatenated.
+        offsets (numpy.ndarray): Offsets of each string in `data`, of length `len(self) + 1`.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._view = memoryview(data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def encoded(self, position):
+        """
+        Returns the UTF-8 bytes of the string at a position.
+        """
+        offsets = self.offsets
+        return self._view[offsets.item(position):offsets.item(position + 1)].tobytes()
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[item] for item in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('string table index out of range')
+        return str(self.encoded(position), 'utf-8')
+
+    def __iter__(self):
+        view = self._view
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield str(view[start:end], 'utf-8')
+
+
+class HashedLookup(Mapping):
+    """
+    Read-only mapping from the strings of a `StringTable` to their position, answered by an open-addressing hash table.
+
+    The hash table is stored in the snapshot along with the strings, so that the lookup does not build any dictionary
+    in memory. Each slot of the table holds the position of a string (-1 for the empty slots): a string is looked up
+    from the slot given by the CRC-32 of its UTF-8 bytes, then in the next slots until it is found or an empty slot is
+    met. The table is at most half full, so that a lookup only compares the key with one or two strings on average.
+    The CRC-32 is scrambled by a Fibonacci multiplication, as the CRC-32 of similar strings would fill runs of slots.
+
+    Args:
+        table (StringTable): The strings.
+        slots (numpy.ndarray): The hash table, whose length is a power of two, built by `_hash_strings`.
+    """
+
+    def __init__(self, table, slots):
+        self.table = table
+        self.slots = slots
+
+    def __getitem__(self, key):
+        try:
+            encoded = key.encode('utf-8')
+        except (AttributeError, UnicodeEncodeError):
+            raise KeyError(key) from None
+        slots = self.slots
+        mask = len(slots) - 1
+        slot = _hash_slot(encoded, mask)
+        while True:
+            position = slots.item(slot)
+            if position < 0:
+                raise KeyError(key)
+            if self.table.encoded(position) == encoded:
+                return position
+            slot = (slot + 1) & mask
+
+    def __iter__(self):
+        for position in self.slots[self.slots >= 0].tolist():
+            yield self.table[position]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.slots >= 0))
+
+
+def _hash_slot(encoded, mask):
+    # Keeps the high bits of the product, which depend on every bit of the CRC-32
+    return (zlib.crc32(encoded) * 0x9E3779B1 & 0xFFFFFFFF) >> (32 - mask.bit_length())
+
+
+def _hash_strings(encoded, first=True):
+    """
+    Builds the hash table of a `HashedLookup` (see its description).
+
+    Args:
+        encoded (list): The UTF-8 bytes of the strings.
+        first (bool, optional): Whether a string present several times maps to its first position (as `id_to_code`)
+                                or to its last one (as `label_to_code`). Defaults to True.
+
+    Returns:
+        numpy.ndarray: The slots of the table, each holding the position of a string or -1.
+    """
+    slots = [-1] * (1 << (2 * len(encoded) - 1).bit_length())
+    mask = len(slots) - 1
+    for position in range(len(encoded)) if first else reversed(range(len(encoded))):
+        value = encoded[position]
+        slot = _hash_slot(value, mask)
+        while slots[slot] >= 0 and encoded[slots[slot]] != value:
+            slot = (slot + 1) & mask
+        if slots[slot] < 0:
+            slots[slot] = position
+    return np.array(slots, dtype=np.int32)
+
+
+def _encode_strings(values, first=True):
+    """
+    Encodes a list of strings into the arrays of a `StringTable` and of its `HashedLookup`.
+
+    Returns:
+        tuple: The concatenated UTF-8 bytes, the offsets of the strings, and the slots of their hash table.
+    """
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, _hash_strings(encoded, first)
+
+
+def write_snapshot(index, path):
+    """
+    Compiles an index into a binary snapshot file.
+
+    The file starts with a magic number, the length of a JSON header and the header itself, which describes the
+    arrays (dtype, shape, offset) stored after it: the tables of labels and Class IDs (UTF-8 bytes, offsets and hash
+    table, see `StringTable` and `HashedLookup`), the parent and children adjacencies, the cycle flags and components,
+    the sorted keys of the label search (see `LabelSearch`) and the ancestor closure if it has been precomputed. The
+    file is written next to its final path and then renamed, so that readers never see a partial snapshot.
+
+    Args:
+        index (OntologyIndex): The index to compile.
+        path (str): Path of the snapshot file.
+    """
+    arrays = {}
+    # The label lookup keeps the last occurrence of a label, the Class ID one the first occurrence of an ID
+    for name, first in (('labels', False), ('class_ids', True)):
+        data, offsets, slots = _encode_strings(getattr(index, name), first)
+        arrays.update({f'{name}_data': data, f'{name}_offsets': offsets, f'{name}_slots': slots})
+    search = index.label_search if index.label_search is not None else LabelSearch.from_labels(index.labels)
+    data, offsets, _ = _encode_strings(search.keys)
+    arrays.update({'search_keys_data': data, 'search_keys_offsets': offsets, 'search_codes': search.codes})
+    arrays.update({'parent_offsets': index.parent_offsets,
+                   'parent_codes': index.parent_codes,
+                   'child_offsets': index.child_offsets,
+                   'child_codes': index.child_codes,
+                   'in_cycle': index.in_cycle,
+                   'component': index.component})
+    closure = index.closure
+    if closure is not None:
+        arrays.update({'closure_offsets': closure.offsets,
+                       'closure_ancestors': closure.ancestors,
+                       'closure_depths': closure.depths})
+
+    header = {'version': SNAPSHOT_VERSION,
+              'size': len(index),
+              'closure_depth': closure.depth if closure is not None else None,
+              'arrays': {}}
+    position = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.snapshot-', delete=False) as file:
+        try:
+            file.write(SNAPSHOT_MAGIC)
+            file.write(len(header_bytes).to_bytes(8, 'little'))
+            file.write(header_bytes)
+            for name, array in arrays.items():
+                file.seek(data_start + header['arrays'][name]['offset'])
+                file.write(array.tobytes())
+            file.truncate(data_start + position)
+        except BaseException:
+            os.unlink(file.name)
+            raise
+    os.chmod(file.name, 0o644)
+    os.replace(file.name, path)
+
+
+def load_snapshot(path):
+    """
+    Loads an index from a snapshot file written by `write_snapshot`.
+
+    The whole file is mapped in memory with `numpy.memmap`, and the arrays of the index are zero-copy views of it,
+    including the tables of labels and Class IDs and their lookups: the pages of the file are shared by every process
+    which loads the same snapshot (e.g. the workers of the API), and only the strings used by a query are decoded.
+
+    Args:
+        path (str): Path of the snapshot file.
+
+    Returns:
+        OntologyIndex: The index, with its ancestor closure if the snapshot contains one.
+
+    Raises:
+        ValueError: If the file is not a snapshot, or was written by an incompatible version.
+    """
+    with open(path, 'rb') as file:
+        magic = file.read(len(SNAPSHOT_MAGIC))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not an ontology snapshot.')
+        header_length = int.from_bytes(file.read(8), 'little')
+        header = json.loads(file.read(header_length))
+    if header['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f"The snapshot {path} has version {header['version']}, expected {SNAPSHOT_VERSION}.")
+
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        count = int(np.prod(layout['shape']))
+        start = data_start + layout['offset']
+        # Plain arrays rather than memmaps, whose slices (e.g. the parents of a node) are slower to create
+        arrays[name] = buffer[start:start + count * dtype.itemsize].view(dtype, np.ndarray).reshape(layout['shape'])
+
+    labels = StringTable(arrays['labels_data'], arrays['labels_offsets'])
+    class_ids = StringTable(arrays['class_ids_data'], arrays['class_ids_offsets'])
+    index = OntologyIndex(class_ids,
+                          labels,
+                          arrays['parent_offsets'],
+                          arrays['parent_codes'],
+                          arrays['in_cycle'],
+                          child_offsets=arrays['child_offsets'],
+                          child_codes=arrays['child_codes'],
+                          component=arrays['component'])
+    index.label_to_code = HashedLookup(labels, arrays['labels_slots'])
+    index.id_to_code = HashedLookup(class_ids, arrays['class_ids_slots'])
+    index.label_search = LabelSearch(StringTable(arrays['search_keys_data'], arrays['search_keys_offsets']),
+                                     arrays['search_codes'])
+    if header['closure_depth'] is not None:
+        index.closure = AncestorClosure(header['closure_depth'],
+                                        arrays['closure_offsets'],
+                                        arrays['closure_ancestors'],
+                                        arrays['closure_depths'])
+    return index
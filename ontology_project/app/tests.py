@@ -1,5 +1,24 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import api
+import ontology_service
+from ontology_cache import ResultCache, result_size
+from ontology_csv import read_ontology_csv
+from ontology_diff import apply_diff
 from ontology_helper import *
+from ontology_index import OntologyIndex, RelativesMemo
+from ontology_metrics import Histogram, StageTimings
+from ontology_search import LabelSearch, normalize_label
+from ontology_service import (get_ontology_index, iter_batch_results, reload_ontology_index, resolve_label,
+                              unresolved_label_message)
+from ontology_snapshot import HashedLookup, StringTable, _encode_strings, _hash_slot, load_snapshot, write_snapshot
+import httpx
 import pandas as pd
 import numpy as np
 
@@ -62,6 +81,15 @@ class MyTestCase(unittest.TestCase):
         df_with_cycles_identified = identify_cycles(df_with_cyles)
         pd.testing.assert_frame_equal(target_df, df_with_cycles_identified)
 
+    def test_all_cycles_identification(self):
+        df_with_cycles = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E', 'F', 'G'],
+                                       'Preferred Label': ['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+                                       'Parents': ['B', 'A', 'D', 'E|G', 'C', 'F', 'None']})
+
+        df_with_cycles_identified = identify_cycles(df_with_cycles)
+        self.assertListEqual([True, True, True, True, True, True, False],
+                             df_with_cycles_identified['In Cycle'].tolist())
+
     def test_whole_preprocessing(self):
         base_df = pd.DataFrame({'Class ID': ['http://entity1/', 'http://entity2/', 'http://entity3/'],
                                 'Preferred Label': ['entity1', 'entity2', 'entity1'],
@@ -126,10 +154,11 @@ class MyTestCase(unittest.TestCase):
                                        'Parents': ['B|C', 'A', 'D|E', 'None', 'None'],
                                        'In Cycle': [True, True, False, False, False]})
 
-        target_ontology1 = {'a': f"Entered a cyclic parenthood at level 0 (direct parents: B|C). The parenthood concerning the b's branch will be ignored.",
-                            'c':1,
-                            'd':2,
-                            'e':2
+        target_ontology1 = {'a': 0,
+                            'b': 1,
+                            'c': 1,
+                            'd': 2,
+                            'e': 2
                             }
         complex_ontology1 = get_ontology('a', df_with_cycles)
         self.assertDictEqual(target_ontology1, complex_ontology1)
@@ -140,6 +169,376 @@ class MyTestCase(unittest.TestCase):
         complex_ontology2 = get_ontology('c', df_with_cycles)
         self.assertDictEqual(target_ontology2, complex_ontology2)
 
+    def test_ontology_through_cycles(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'e'],
+                           'Parents': ['B', 'C', 'D|E', 'B', 'None'],
+                           'In Cycle': [False, True, True, True, False]})
+
+        target_shortest = {'a': 0,
+                           'b': 1,
+                           'c': 2,
+                           'd': 3,
+                           'e': 3
+                           }
+        self.assertDictEqual(target_shortest, get_ontology('a', df))
+
+        target_longest = {'a': 0,
+                          'b': 1,
+                          'c': 1,
+                          'd': 1,
+                          'e': 2
+                          }
+        self.assertDictEqual(target_longest, get_ontology('a', df, depth='longest'))
+
+    def test_ontology_shared_ancestors(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D'],
+                           'Preferred Label': ['a', 'b', 'c', 'd'],
+                           'Parents': ['B|D', 'C', 'D', 'None'],
+                           'In Cycle': [False, False, False, False]})
+
+        target_shortest = {'a': 0,
+                           'b': 1,
+                           'c': 2,
+                           'd': 1
+                           }
+        self.assertDictEqual(target_shortest, get_ontology('a', df))
+
+        target_longest = {'a': 0,
+                          'b': 1,
+                          'c': 2,
+                          'd': 3
+                          }
+        self.assertDictEqual(target_longest, get_ontology('a', df, depth='longest'))
+
+        with self.assertRaises(ValueError):
+            get_ontology('a', df, depth='average')
+
+    def test_ontology_deep_hierarchy(self):
+        size = 5000
+        df = pd.DataFrame({'Class ID': [f'ID{i}' for i in range(size)],
+                           'Preferred Label': [f'label{i}' for i in range(size)],
+                           'Parents': [f'ID{i + 1}' for i in range(size - 1)] + ['None'],
+                           'In Cycle': [False] * size})
+
+        self.assertFalse(identify_cycles(df.drop(columns='In Cycle'))['In Cycle'].any())
+        deep_ontology = get_ontology('label0', OntologyIndex.from_dataframe(df))
+        self.assertEqual(size, len(deep_ontology))
+        self.assertEqual(size - 1, deep_ontology[f'label{size - 1}'])
+
+    def test_ontology_descendants(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'e'],
+                           'Parents': ['B|C', 'None', 'D|E', 'None', 'None'],
+                           'In Cycle': [False, False, False, False, False]})
+
+        index = OntologyIndex.from_dataframe(df)
+        self.assertListEqual([2], index.children_of(4))
+        self.assertListEqual([0], index.children_of(2))
+        self.assertListEqual([], index.children_of(0))
+
+        target_descendants = {'d': 0,
+                              'c': -1,
+                              'a': -2
+                              }
+        self.assertDictEqual(target_descendants, get_ontology('d', index, direction='descendants'))
+
+        target_both = {'a': -1,
+                       'c': 0,
+                       'd': 1,
+                       'e': 1
+                       }
+        self.assertDictEqual(target_both, get_ontology('c', index, direction='both'))
+
+        with self.assertRaises(ValueError):
+            get_ontology('c', index, direction='siblings')
+
+    def test_ontology_from_closure(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E', 'F'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'e', 'f'],
+                           'Parents': ['B|C', 'A', 'D|E', 'E', 'None', 'C|D'],
+                           'In Cycle': [True, True, False, False, False, False]})
+
+        for depth in ('shortest', 'longest'):
+            index = OntologyIndex.from_dataframe(df)
+            expected = {label: get_ontology(label, index, depth=depth) for label in index.labels}
+
+            closure = index.precompute_closure(depth)
+            self.assertEqual(14, len(closure))
+            self.assertEqual(closure.offsets.nbytes + closure.ancestors.nbytes + closure.depths.nbytes, closure.nbytes)
+            for label in index.labels:
+                self.assertDictEqual(expected[label], get_ontology(label, index, depth=depth))
+
+    def test_ontology_batch_memo(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E', 'F', 'G'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+                           'Parents': ['B|C', 'A', 'D|E', 'E|F', 'None', 'D', 'C|E'],
+                           'In Cycle': [True, True, False, True, False, True, False]})
+
+        # The second case does not flag the cycle between D and F, to check the breadth-first fallback
+        df_unflagged = df.assign(**{'In Cycle': [True, True, False, False, False, False, False]})
+        for frame, depths in ((df, ('shortest', 'longest')), (df_unflagged, ('shortest',))):
+            index = OntologyIndex.from_dataframe(frame)
+            for depth in depths:
+                memo = RelativesMemo(index, depth)
+                for direction in ('ancestors', 'descendants', 'both'):
+                    for label in ['g', 'a', 'b', 'c', 'd', 'e', 'f']:
+                        self.assertDictEqual(get_ontology(label, index, depth=depth, direction=direction),
+                                             get_ontology(label, index, direction=direction, memo=memo))
+
+    def test_snapshot_round_trip(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'é'],
+                           'Parents': ['B|C', 'A', 'D|E', 'None', 'None'],
+                           'In Cycle': [True, True, False, False, False]})
+
+        index = OntologyIndex.from_dataframe(df)
+        index.precompute_closure('longest')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'onto.csv.snapshot')
+            write_snapshot(index, path)
+            loaded = load_snapshot(path)
+
+            self.assertListEqual(index.class_ids, list(loaded.class_ids))
+            self.assertListEqual(index.labels, list(loaded.labels))
+            for name in ('parent_offsets', 'parent_codes', 'child_offsets', 'child_codes', 'in_cycle', 'component'):
+                np.testing.assert_array_equal(getattr(index, name), getattr(loaded, name))
+            self.assertEqual('longest', loaded.closure.depth)
+            self.assertDictEqual(index.label_to_code, dict(loaded.label_to_code))
+            self.assertDictEqual(index.id_to_code, dict(loaded.id_to_code))
+            self.assertNotIn('z', loaded)
+            search = LabelSearch.from_labels(index.labels)
+            self.assertListEqual(search.keys, list(loaded.label_search.keys))
+            np.testing.assert_array_equal(search.codes, loaded.label_search.codes)
+            self.assertListEqual([4], loaded.label_search.matches('É'))
+            for label in index.labels:
+                self.assertDictEqual(get_ontology(label, index, depth='longest', direction='both'),
+                                     get_ontology(label, loaded, depth='longest', direction='both'))
+            del loaded
+
+    def test_hashed_lookup(self):
+        # Enough strings for some of them to collide and be stored away from their first slot
+        values = [f'entity {number}' for number in range(200)] + ['entity 7', '', 'é']
+        data, offsets, slots = _encode_strings(values, first=True)
+        lookup = HashedLookup(StringTable(data, offsets), slots)
+        mask = len(slots) - 1
+        self.assertTrue(any(slots[_hash_slot(value.encode('utf-8'), mask)] != position
+                            for position, value in enumerate(values[:200])))
+        self.assertEqual(len(set(values)), len(lookup))
+        self.assertDictEqual({value: position for position, value in reversed(list(enumerate(values)))}, dict(lookup))
+        self.assertEqual(7, lookup['entity 7'])
+        for key in ('entity 200', 'Entity 7', None, 7):
+            self.assertNotIn(key, lookup)
+            self.assertIsNone(lookup.get(key))
+        with self.assertRaises(KeyError):
+            lookup['entity 200']
+        _, _, last_slots = _encode_strings(values, first=False)
+        self.assertEqual(200, HashedLookup(StringTable(data, offsets), last_slots)['entity 7'])
+
+        # Through a snapshot, with a duplicated Class ID and relatives ranked by the codes filled by the traversal
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'A', 'E'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'e'],
+                           'Parents': ['B|C', 'E', 'E', 'C|B', 'None'],
+                           'In Cycle': [False] * 5})
+        index = OntologyIndex.from_dataframe(df)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'onto.csv.snapshot')
+            write_snapshot(index, path)
+            loaded = load_snapshot(path)
+            self.assertIsInstance(loaded.label_to_code, HashedLookup)
+            self.assertEqual(0, loaded.id_to_code['A'])
+            self.assertIsNone(loaded.code_of('f'))
+            for label in ('a', 'd'):
+                codes = {}
+                onto_dict = get_ontology(label, loaded, codes=codes)
+                self.assertDictEqual({relative: loaded.code_of(relative) for relative in onto_dict}, codes)
+                self.assertListEqual(list(select_first_entities(onto_dict, 3, index.code_of)),
+                                     list(select_first_entities(onto_dict, 3, codes.__getitem__)))
+                self.assertListEqual(list(select_first_dense_entities(index, onto_dict, 5)),
+                                     list(select_first_dense_entities(loaded, onto_dict, 5, codes.__getitem__)))
+            # 'b' and 'c' are at the same level: they are ranked by code, as the rows of the csv file
+            codes = {}
+            onto_dict = get_ontology('a', loaded, codes=codes)
+            self.assertListEqual(['e', 'b', 'c', 'a'], list(select_first_entities(onto_dict, 4, codes.__getitem__)))
+            del loaded
+
+    def test_index_hot_reload(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C'],
+                           'Preferred Label': ['a', 'b', 'c'],
+                           'Parents': ['B', 'C', np.nan]})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'onto.csv')
+            df.to_csv(path, index=False)
+            index = get_ontology_index(path)
+            self.assertIs(index, get_ontology_index(path))
+
+            new_df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D'],
+                                   'Preferred Label': ['a', 'b', 'c', 'd'],
+                                   'Parents': ['B|D', 'C', np.nan, np.nan]})
+            new_df.to_csv(path, index=False)
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+            new_index = reload_ontology_index(path)
+
+            self.assertIs(new_index, get_ontology_index(path))
+            self.assertNotEqual(index.version, new_index.version)
+            self.assertDictEqual({'a': 0, 'b': 1, 'c': 2}, get_ontology('a', index))
+            self.assertDictEqual({'a': 0, 'b': 1, 'd': 1, 'c': 2}, get_ontology('a', new_index))
+
+    def test_ontology_diff(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H'],
+                           'Preferred Label': ['a', 'b', 'c', 'a', 'e', 'f', 'g', 'a'],
+                           'Parents': ['B', 'C', np.nan, 'C', 'A|D', 'E', 'F', 'G']})
+        changed = [{'Class ID': 'C', 'Preferred Label': 'c', 'Parents': 'E'},
+                   {'Class ID': 'G', 'Preferred Label': 'a', 'Parents': 'F'}]
+        added = [{'Class ID': 'I', 'Preferred Label': 'b', 'Parents': 'H|D|X'}]
+        # The same release of the ontology, written as a whole: it creates the cycle A -> B -> C -> E -> A
+        new_df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'E', 'F', 'G', 'H', 'I'],
+                               'Preferred Label': ['a', 'b', 'c', 'e', 'f', 'a', 'a', 'b'],
+                               'Parents': ['B', 'C', 'E', 'A|D', 'E', 'F', 'G', 'H|D|X']})
+
+        index = OntologyIndex.from_dataframe(preprocess_dataframe(df.copy()))
+        index.precompute_closure('longest')
+        before = {label: get_ontology(label, index, depth='longest', direction='both') for label in index.labels}
+        new_index = apply_diff(index, added=added, removed=['D'], changed=changed)
+        expected = OntologyIndex.from_dataframe(preprocess_dataframe(new_df))
+
+        self.assertCountEqual(expected.labels, [label for label in new_index.labels if label is not None])
+        self.assertNotIn('g', new_index)
+        self.assertEqual('G', new_index.class_ids[new_index.code_of('a_2')])
+        for label in expected.labels:
+            self.assertEqual(expected.in_cycle[expected.code_of(label)], new_index.in_cycle[new_index.code_of(label)])
+            for depth in ('shortest', 'longest'):
+                self.assertDictEqual(get_ontology(label, expected, depth=depth, direction='both'),
+                                     get_ontology(label, new_index, depth=depth, direction='both'))
+        for label in index.labels:
+            self.assertDictEqual(before[label], get_ontology(label, index, depth='longest', direction='both'))
+
+        # Breaking the cycle again
+        newer_index = apply_diff(new_index, changed=[{'Class ID': 'C', 'Preferred Label': 'c', 'Parents': None}])
+        expected = OntologyIndex.from_dataframe(preprocess_dataframe(new_df.assign(Parents=['B', 'C', np.nan, 'A|D', 'E', 'F', 'G', 'H|D|X'])))
+        self.assertFalse(newer_index.in_cycle.any())
+        for label in expected.labels:
+            self.assertDictEqual(get_ontology(label, expected, depth='longest', direction='both'),
+                                 get_ontology(label, newer_index, depth='longest', direction='both'))
+
+        with self.assertRaises(ValueError):
+            apply_diff(newer_index, removed=['D'])
+        for row in ({'Class ID': 'J', 'Preferred Label': None, 'Parents': 'A'},
+                    {'Class ID': '', 'Preferred Label': 'j', 'Parents': 'A'}):
+            with self.assertRaises(ValueError):
+                apply_diff(newer_index, added=[row])
+
+    def test_result_cache(self):
+        results = {label: {label: 1, 'root': 2} for label in ['a', 'b', 'c']}
+        cache = ResultCache(2 * result_size(results['a']))
+
+        cache.put(('v1', 'a'), results['a'])
+        cache.put(('v1', 'b'), results['b'])
+        self.assertIs(results['a'], cache.get(('v1', 'a')))
+        cache.put(('v1', 'c'), results['c'])
+
+        # 'b' was the least recently used result
+        self.assertIsNone(cache.get(('v1', 'b')))
+        self.assertIs(results['c'], cache.get(('v1', 'c')))
+        self.assertEqual(1, cache.invalidate(lambda key: key[1] == 'a'))
+        self.assertIsNone(cache.get(('v1', 'a')))
+        self.assertDictEqual({'entries': 1, 'bytes': result_size(results['c']), 'max_bytes': cache.max_bytes,
+                              'hits': 2, 'misses': 2, 'evictions': 1}, cache.stats())
+        # The labels are counted, as the ones decoded from a snapshot belong to the result
+        self.assertGreater(result_size({'x' * 1000: 1}), 1000)
+
+    def test_first_entities_selection(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E', 'F', 'G'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'e', 'f', 'g'],
+                           'Parents': ['B|C', 'D', 'D', 'None', 'A', 'None', 'E'],
+                           'In Cycle': [False] * 7})
+
+        index = OntologyIndex.from_dataframe(df)
+        onto_dict = get_ontology('a', index, direction='both')
+        dense = sort_dictionary(fill_dictionary_with_ontology_results(index.empty_dictionary(), onto_dict))
+        sparse = {label: level for label, level in dense.items() if label in onto_dict}
+        for n in range(len(index) + 2):
+            self.assertListEqual(list(dense.items())[:n], list(select_first_dense_entities(index, onto_dict, n).items()))
+            self.assertListEqual(list(sparse.items())[:n], list(select_first_entities(onto_dict, n, index.code_of).items()))
+
+    def test_streaming_csv_ingestion(self):
+        # The second row of 'F' makes a cycle of the Class ID 'F', which flags both of its rows
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E', 'F', 'F'],
+                           'Preferred Label': ['a', 'b', 'a', 'd', 'a', 'f', 'g'],
+                           'Parents': ['B|X', 'C', 'A|F', np.nan, 'D|D', 'G', 'F'],
+                           'Synonyms': ['', 'b, bb', '', '', '', '', '']})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'onto.csv')
+            df.to_csv(path, index=False)
+            expected = OntologyIndex.from_dataframe(preprocess_dataframe(pd.read_csv(path)))
+            for chunk_rows in (1, 4, 100):
+                index = read_ontology_csv(path, chunk_rows)
+                self.assertListEqual(expected.class_ids, index.class_ids)
+                self.assertListEqual(expected.labels, index.labels)
+                np.testing.assert_array_equal(expected.parent_offsets, index.parent_offsets)
+                np.testing.assert_array_equal(expected.parent_codes, index.parent_codes)
+                np.testing.assert_array_equal(expected.in_cycle, index.in_cycle)
+                self.assertTrue(index.in_cycle[5] and index.in_cycle[6])
+
+            df.drop(columns='Parents').to_csv(path, index=False)
+            with self.assertRaises(ValueError) as context:
+                read_ontology_csv(path)
+            self.assertIn('Parents', str(context.exception))
+
+    def test_stage_metrics(self):
+        histogram = Histogram('test_seconds', 'Durations of the test.', 'stage', (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, 'load')
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="load",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="load",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="load",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{stage="load"} 4', lines)
+
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C'],
+                           'Preferred Label': ['a', 'b', 'c'],
+                           'Parents': ['B', 'C', np.nan]})
+        timings = StageTimings()
+        index = OntologyIndex.from_dataframe(preprocess_dataframe(df, timings))
+        lines = list(iter_batch_results(index, ['a', 'b', 'z'], timings=timings))
+        self.assertEqual(3, len(lines))
+        self.assertListEqual(['check_required_columns', 'replace_nan_values', 'rename_duplicates', 'identify_cycles',
+                              'traversal', 'select', 'serialize', 'search_build'], list(timings.seconds))
+        self.assertEqual(5, timings.items['traversal'])
+        self.assertIn('traversal;dur=', timings.server_timing())
+
+    def test_label_search(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E'],
+                           'Preferred Label': ['Dermatoses', 'DERMATITIS', 'Skin  Disorders', 'dermatoses', 'Anemia'],
+                           'Parents': ['C', 'C', 'None', 'C', 'None'],
+                           'In Cycle': [False, False, False, False, False]})
+        index = OntologyIndex.from_dataframe(df)
+        search = LabelSearch.from_labels(index.labels)
+
+        self.assertEqual('skin disorders', normalize_label(' Skin\tDISORDERS '))
+        self.assertListEqual([0, 3], search.matches('DERMATOSES'))
+        self.assertListEqual([2], search.matches('skin disorders'))
+        self.assertListEqual([1, 0, 3], search.complete('derm'))
+        self.assertListEqual([1], search.complete('derm', limit=1))
+        self.assertListEqual([], search.complete('x'))
+        self.assertEqual(4, search.suggest('anemai')[0][0])
+        self.assertListEqual([], search.suggest('zzzz'))
+
+        self.assertEqual('Anemia', resolve_label(index, 'Anemia'))
+        self.assertEqual('Anemia', resolve_label(index, 'E'))
+        self.assertIsNone(index.label_search)
+        timings = StageTimings()
+        self.assertEqual('Skin  Disorders', resolve_label(index, 'skin disorders', timings))
+        self.assertIn('search_build', timings.seconds)
+        # Two labels only differ by their case
+        self.assertIsNone(resolve_label(index, 'DERMATOSES'))
+        self.assertEqual("The entity 'DERMATOSES' is ambiguous, it may designate 'Dermatoses', 'dermatoses'. Please, use "
+                         "one of these labels.", unresolved_label_message(index, 'DERMATOSES'))
+        self.assertIsNone(resolve_label(index, 'Z'))
+        self.assertIn('is not present in the CSV', unresolved_label_message(index, 'Z'))
+
     def test_dict_initialization(self):
         df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D'],
                            'Preferred Label': ['a', 'b', 'c', 'd'],
@@ -205,5 +604,186 @@ class MyTestCase(unittest.TestCase):
         dict_sorted2 = sort_dictionary(unsorted_dict2)
         self.assertDictEqual(target_dict2, dict_sorted2)
 
+    def test_index_construction(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D'],
+                           'Preferred Label': ['a', 'b', 'c', 'd'],
+                           'Parents': ['B|C', 'None', 'D|E', 'None'],
+                           'In Cycle': [False, False, False, False]})
+
+        index = OntologyIndex.from_dataframe(df)
+        self.assertEqual(4, len(index))
+        self.assertIn('a', index)
+        self.assertNotIn('e', index)
+        self.assertEqual(2, index.id_to_code['C'])
+        self.assertEqual(3, index.label_to_code['d'])
+        self.assertListEqual([1, 2], index.parents_of(0))
+        self.assertListEqual([], index.parents_of(1))
+        self.assertListEqual([3], index.parents_of(2))
+        self.assertDictEqual(initialize_empty_dictionary_from_df(df), index.empty_dictionary())
+
+    def test_api_executor(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C', 'D', 'E'],
+                           'Preferred Label': ['a', 'b', 'c', 'd', 'e'],
+                           'Parents': ['B', 'C', np.nan, 'A', 'D']})
+        released = threading.Event()
+        threads = []
+        render = api.render_query_result
+        read_lines = api.read_lines
+
+        def blocking_render(*args):
+            # Records where the response is computed, and blocks the executor until `released` is set
+            threads.append(threading.current_thread().name)
+            released.wait(5)
+            return render(*args)
+
+        def counting_read_lines(lines):
+            chunk = read_lines(lines)
+            threads.append((threading.current_thread().name, chunk.count('\n')))
+            return chunk
+
+        async def wait_pending(count):
+            for _ in range(500):
+                if api.pending_queries == count:
+                    return
+                await asyncio.sleep(0.01)
+            self.fail(f'{api.pending_queries} pending queries, expected {count}')
+
+        async def run(path):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://test') as client:
+                query = {'dir_csv': path, 'label': 'a', 'n': 10}
+                # A query blocked in the executor holds the only slot: the next one is rejected
+                first = asyncio.create_task(client.post('/query-ontology/', json=query))
+                await wait_pending(1)
+                response = await client.post('/query-ontology/', json={**query, 'label': 'b'})
+                self.assertEqual(503, response.status_code)
+                self.assertEqual('1', response.headers['Retry-After'])
+                released.set()
+                response = await first
+                self.assertEqual(200, response.status_code)
+                self.assertDictEqual({'c': 2, 'b': 1, 'a': 0}, response.json())
+                self.assertTrue(threads.pop().startswith('ontology-query'))
+                await wait_pending(0)
+
+                # A small cached result is answered from the event loop
+                response = await client.post('/query-ontology/', json=query)
+                self.assertDictEqual({'c': 2, 'b': 1, 'a': 0}, response.json())
+                self.assertEqual(threading.current_thread().name, threads.pop())
+
+                # A query timing out gets a 504, but keeps its slot until its thread returns
+                released.clear()
+                with mock.patch.object(api, 'QUERY_TIMEOUT', 0.05):
+                    response = await client.post('/query-ontology/', json={**query, 'label': 'd'})
+                self.assertEqual(504, response.status_code)
+                self.assertEqual(1, api.pending_queries)
+                released.set()
+                await wait_pending(0)
+
+                # A batch is computed by chunks of lines in the executor, and holds a slot until it is streamed
+                threads.clear()
+                response = await client.post('/query-ontology/batch', json={'dir_csv': path, 'n': 10,
+                                                                            'labels': ['a', 'b', 'c', 'd', 'z']})
+                lines = [json.loads(line) for line in response.text.splitlines()]
+                self.assertListEqual(['a', 'b', 'c', 'd', 'z'], [line['label'] for line in lines])
+                self.assertIn('error', lines[-1])
+                self.assertListEqual([2, 2, 1, 0], [count for _, count in threads])
+                self.assertTrue(all(name.startswith('ontology-query') for name, _ in threads))
+                await wait_pending(0)
+
+        with tempfile.TemporaryDirectory() as directory, \
+                ThreadPoolExecutor(2, thread_name_prefix='ontology-query') as executor, \
+                mock.patch.object(api, 'executor', executor), mock.patch.object(api, 'MAX_PENDING_QUERIES', 1), \
+                mock.patch.object(api, 'BATCH_CHUNK_LINES', 2), \
+                mock.patch.object(api, 'render_query_result', blocking_render), \
+                mock.patch.object(api, 'read_lines', counting_read_lines):
+            path = os.path.realpath(os.path.join(directory, 'onto.csv'))
+            df.to_csv(path, index=False)
+            get_ontology_index(path)
+            with mock.patch.object(ontology_service, 'SERVED_DIR_CSVS', {path}):
+                asyncio.run(run(path))
+            released.set()
+
+    def test_api_endpoints(self):
+        df = pd.DataFrame({'Class ID': ['A', 'B', 'C'],
+                           'Preferred Label': ['a', 'b', 'Cervix'],
+                           'Parents': ['B', 'C', np.nan]})
+
+        admin = {'Authorization': 'Bearer secret'}
+
+        async def run(path):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://test') as client:
+                response = await client.post('/query-ontology/', json={'dir_csv': path, 'label': 'a'})
+                version = response.headers['X-Ontology-Version']
+                # Another spelling of the same file is served by the same index, and other files are not served
+                other_spelling = os.path.join(os.path.dirname(path), '.', os.path.basename(path))
+                response = await client.post('/query-ontology/', json={'dir_csv': other_spelling, 'label': 'a'})
+                self.assertEqual(version, response.headers['X-Ontology-Version'])
+                for request in (client.post('/query-ontology/', json={'dir_csv': '/etc/passwd', 'label': 'a'}),
+                                client.get('/search', params={'q': 'a', 'dir_csv': path + '.other'})):
+                    self.assertEqual(404, (await request).status_code)
+                # A Class ID or a label with another case designate the same entity
+                for label in ('A', ' A '):
+                    response = await client.post('/query-ontology/', json={'dir_csv': path, 'label': label})
+                    self.assertDictEqual({'Cervix': 2, 'b': 1, 'a': 0}, response.json())
+
+                response = await client.get('/search', params={'q': 'CERV', 'dir_csv': path})
+                self.assertEqual(version, response.headers['X-Ontology-Version'])
+                self.assertDictEqual({'match': None, 'completions': [{'label': 'Cervix', 'class_id': 'C'}],
+                                      'suggestions': []}, response.json())
+                response = await client.get('/search', params={'q': 'cervic', 'dir_csv': path})
+                self.assertEqual('Cervix', response.json()['suggestions'][0]['label'])
+                response = await client.get('/search', params={'q': 'cervix', 'limit': 0, 'dir_csv': path})
+                self.assertDictEqual({'match': {'label': 'Cervix', 'class_id': 'C'}, 'completions': [],
+                                      'suggestions': []}, response.json())
+                self.assertEqual(f'"{version}"', response.headers['ETag'])
+
+                stats = (await client.get('/admin/cache')).json()
+                self.assertGreaterEqual(stats['entries'], 1)
+                metrics = (await client.get('/metrics')).text
+                self.assertIn('ontology_stage_seconds_count{stage="traversal"}', metrics)
+                self.assertIn('ontology_pending_queries 0', metrics)
+
+                diff = {'dir_csv': path, 'added': [{'Class ID': 'D', 'Preferred Label': 'd', 'Parents': 'A'}]}
+                self.assertEqual(401, (await client.post('/admin/diff', json=diff)).status_code)
+                response = await client.post('/admin/diff', json={**diff, 'dir_csv': path + '.new'}, headers=admin)
+                self.assertEqual(404, response.status_code)
+                response = await client.post('/admin/diff', json=diff, headers=admin)
+                self.assertEqual(200, response.status_code)
+                self.assertNotEqual(version, response.json()['version'])
+                response = await client.post('/query-ontology/', json={'dir_csv': path, 'label': 'd'})
+                self.assertDictEqual({'Cervix': 3, 'b': 2, 'a': 1, 'd': 0}, response.json())
+                response = await client.post('/admin/diff', json={'dir_csv': path, 'removed': ['X']}, headers=admin)
+                self.assertEqual(400, response.status_code)
+                response = await client.post('/admin/diff', json={'dir_csv': path, 'added': [
+                    {'Class ID': 'E', 'Preferred Label': None, 'Parents': 'A'}]}, headers=admin)
+                self.assertEqual(422, response.status_code)
+
+                with mock.patch.object(api, 'ADMIN_TOKEN', None):
+                    response = await client.post('/admin/reload', json={'dir_csv': path}, headers=admin)
+                self.assertEqual(403, response.status_code)
+                response = await client.post('/admin/reload', json={'dir_csv': path},
+                                             headers={'Authorization': 'Bearer x'})
+                self.assertEqual(401, response.status_code)
+                # A file the API may serve but has not loaded yet is not loaded by a reload
+                response = await client.post('/admin/reload', json={'dir_csv': path + '.new'}, headers=admin)
+                self.assertEqual(404, response.status_code)
+                response = await client.post('/admin/reload', json={'dir_csv': path}, headers=admin)
+                self.assertEqual(202, response.status_code)
+                for thread in threading.enumerate():
+                    if thread.name == 'ontology-reload':
+                        thread.join(5)
+                # The reload brings back the content of the file, without the diff
+                response = await client.post('/query-ontology/', json={'dir_csv': path, 'label': 'd'})
+                self.assertIsInstance(response.json(), str)
+
+        with tempfile.TemporaryDirectory() as directory, \
+                ThreadPoolExecutor(2, thread_name_prefix='ontology-query') as executor, \
+                mock.patch.object(api, 'executor', executor):
+            path = os.path.join(directory, 'onto.csv')
+            df.to_csv(path, index=False)
+            served = {os.path.realpath(path), os.path.realpath(path + '.new')}
+            with mock.patch.object(ontology_service, 'SERVED_DIR_CSVS', served), \
+                    mock.patch.object(api, 'ADMIN_TOKEN', 'secret'):
+                asyncio.run(run(path))
+
 if __name__ == '__main__':
     unittest.main()
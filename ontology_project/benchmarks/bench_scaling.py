@@ -0,0 +1,207 @@
+"""
+Measures how each stage of the ontology pipeline scales with the size of the ontology.
+
+For each size, a synthetic ontology is generated (see `synthetic.py`) and processed in a new process, so that its
+memory peak is not inherited from the previous sizes. The stages measured are:
+    - load: reading the CSV file with pandas,
+    - preprocess: `preprocess_dataframe`,
+    - index: building the `OntologyIndex` of the preprocessed DataFrame,
+    - csv_index: building the same index with `read_ontology_csv`, which streams the CSV file without pandas and is
+      the loader of the service,
+    - query: `get_ontology` for labels drawn at random,
+    - response: the response of `/query-ontology/` (first `n` relatives) for the same labels, also measured in the
+      dense mode (every label of the ontology),
+    - batch: `iter_batch_results` over a batch of labels.
+The peak resident memory is reported after each stage. As it never decreases, the memory of the two loaders is also
+compared by the peak traced by `tracemalloc`, each loader being run again under it (as it slows the allocations down).
+The buffers of the C parser of pandas are not traced, so that this peak underestimates the one of the pandas path.
+The results are printed as JSON (or written to `--output`), so that they can be compared between commits:
+
+    python benchmarks/bench_scaling.py --sizes 1000,100000,1000000 --output scaling.json
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from ontology_csv import read_ontology_csv
+from ontology_helper import get_ontology, preprocess_dataframe, select_first_dense_entities, select_first_entities
+from ontology_index import DEPTH_MODES, DIRECTIONS, OntologyIndex
+from ontology_service import iter_batch_results
+from synthetic import write_ontology
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of the current process, in megabytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def traced_peak_mb(function, *args):
+    """
+    Calls a function under `tracemalloc` and returns the peak of the memory it allocated, in megabytes.
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def load_dataframe_index(dir_csv):
+    """
+    Builds the index of a CSV file through pandas, as the load, preprocess and index stages do.
+    """
+    import pandas as pd
+
+    return OntologyIndex.from_dataframe(preprocess_dataframe(pd.read_csv(dir_csv)))
+
+
+def latency_summary(seconds):
+    """
+    Summarizes a list of latencies (in seconds) in milliseconds.
+    """
+    milliseconds = np.array(seconds) * 1000
+    return {'median_ms': float(np.median(milliseconds)),
+            'p95_ms': float(np.percentile(milliseconds, 95)),
+            'max_ms': float(milliseconds.max())}
+
+
+def run_size(size, args):
+    """
+    Generates an ontology of a given size and measures every stage of the pipeline on it.
+
+    Args:
+        size (int): Number of entities of the ontology.
+        args (argparse.Namespace): The parameters of the benchmark.
+
+    Returns:
+        dict: The description of the ontology, the duration of each stage, the memory peak after each stage and the
+              traced memory peak of each loader.
+    """
+    import pandas as pd
+
+    result = {'size': size}
+    stages = result['stages'] = {}
+    memory = result['peak_rss_mb'] = {'start': peak_rss_mb()}
+
+    dir_csv = os.path.join(args.workdir, f'synthetic_{size}.csv')
+    started = time.perf_counter()
+    result['ontology'] = write_ontology(dir_csv, size, args.depth, args.branching, args.multi_parent_ratio,
+                                        args.cycle_rate, args.duplicate_ratio, args.seed)
+    result['generate_s'] = time.perf_counter() - started
+    result['csv_mb'] = os.path.getsize(dir_csv) / 2 ** 20
+    memory['generate'] = peak_rss_mb()
+
+    started = time.perf_counter()
+    dataframe = pd.read_csv(dir_csv)
+    stages['load_s'] = time.perf_counter() - started
+    memory['load'] = peak_rss_mb()
+
+    started = time.perf_counter()
+    dataframe = preprocess_dataframe(dataframe)
+    stages['preprocess_s'] = time.perf_counter() - started
+    memory['preprocess'] = peak_rss_mb()
+
+    started = time.perf_counter()
+    index = OntologyIndex.from_dataframe(dataframe)
+    stages['index_s'] = time.perf_counter() - started
+    memory['index'] = peak_rss_mb()
+    result['cyclic_entities'] = int(np.count_nonzero(index.in_cycle))
+    del dataframe
+
+    started = time.perf_counter()
+    read_ontology_csv(dir_csv)
+    stages['csv_index_s'] = time.perf_counter() - started
+    memory['csv_index'] = peak_rss_mb()
+    result['tracemalloc_peak_mb'] = {'load_preprocess_index': traced_peak_mb(load_dataframe_index, dir_csv),
+                                     'csv_index': traced_peak_mb(read_ontology_csv, dir_csv)}
+
+    rng = np.random.default_rng(args.seed)
+    labels = [index.labels[code] for code in rng.integers(0, size, size=args.queries)]
+    durations, relatives = [], []
+    for label in labels:
+        started = time.perf_counter()
+        onto_dict = get_ontology(label, index, depth=args.depth_mode, direction=args.direction)
+        durations.append(time.perf_counter() - started)
+        relatives.append(len(onto_dict))
+    stages['query'] = latency_summary(durations)
+    stages['query']['mean_relatives'] = statistics.mean(relatives)
+    memory['query'] = peak_rss_mb()
+
+    for stage, select in (('response', lambda onto_dict: select_first_entities(onto_dict, args.n, index.code_of)),
+                          ('dense_response', lambda onto_dict: select_first_dense_entities(index, onto_dict, args.n))):
+        durations = []
+        for label in labels[:args.responses]:
+            started = time.perf_counter()
+            json.dumps(select(get_ontology(label, index, depth=args.depth_mode, direction=args.direction)))
+            durations.append(time.perf_counter() - started)
+        stages[stage] = latency_summary(durations)
+        memory[stage] = peak_rss_mb()
+
+    batch = [index.labels[code] for code in rng.integers(0, size, size=args.batch)]
+    started = time.perf_counter()
+    for _ in iter_batch_results(index, batch, args.n, args.depth_mode, args.direction):
+        pass
+    seconds = time.perf_counter() - started
+    stages['batch'] = {'labels': len(batch), 'seconds': seconds, 'labels_per_s': len(batch) / seconds}
+    memory['batch'] = peak_rss_mb()
+
+    if not args.keep:
+        os.remove(dir_csv)
+    return result
+
+
+def main(args):
+    results = []
+    for size in args.sizes:
+        # A new process per size, so that `peak_rss_mb` only covers this size
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            result = executor.submit(run_size, size, args).result()
+        print(f"size {size}: " + ', '.join(f'{stage} {value:.3f}s' for stage, value in result['stages'].items()
+                                            if stage.endswith('_s')), file=sys.stderr)
+        results.append(result)
+
+    report = {'benchmark': 'scaling',
+              'python': sys.version.split()[0],
+              'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir', 'keep')},
+              'results': results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scaling benchmark of the ontology pipeline')
+    parser.add_argument('--sizes', default='1000,10000,100000', type=lambda sizes: [int(size) for size in sizes.split(',')], help='Comma-separated numbers of entities of the generated ontologies')
+    parser.add_argument('--depth', default=8, type=int, help='Number of levels of the hierarchy')
+    parser.add_argument('--branching', default=3.0, type=float, help='Average number of children of an entity')
+    parser.add_argument('--multi_parent_ratio', default=0.1, type=float, help='Fraction of the entities given an extra parent')
+    parser.add_argument('--cycle_rate', default=0.001, type=float, help='Fraction of the entities closing a cycle')
+    parser.add_argument('--duplicate_ratio', default=0.01, type=float, help='Fraction of the entities sharing the label of another one')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the random generators')
+    parser.add_argument('--queries', default=200, type=int, help='Number of single queries timed')
+    parser.add_argument('--responses', default=20, type=int, help='Number of responses timed in each mode')
+    parser.add_argument('--batch', default=10_000, type=int, help='Number of labels of the batch query')
+    parser.add_argument('--n', default=10, type=int, help='Number of entities kept in each response')
+    parser.add_argument('--depth_mode', default='shortest', choices=DEPTH_MODES, help='Depth mode of the queries')
+    parser.add_argument('--direction', default='ancestors', choices=DIRECTIONS, help='Direction of the queries')
+    parser.add_argument('--workdir', default=tempfile.gettempdir(), type=str, help='Directory where the CSV files are generated')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated CSV files')
+    parser.add_argument('--output', default=None, type=str, help='Path of the JSON report, printed on stdout if unset')
+
+    main(parser.parse_args())
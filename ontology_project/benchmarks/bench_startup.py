@@ -0,0 +1,98 @@
+"""
+Measures the startup cost of the CLI: wall time of a single query and import time of its modules.
+
+Each run launches `python -X importtime -m app.main --label ...` in a new process, from the project directory, and
+parses the import times printed on stderr. The results are printed as JSON, so that they can be compared between
+commits:
+
+    python benchmarks/bench_startup.py --label "CERVIX DISORDER" --runs 10 > startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of `python -X importtime`.
+
+    Every imported module is reported, including the ones imported by another module (whose names are indented by
+    their nesting level in the output), so that a heavy dependency is found wherever it is imported from.
+
+    Args:
+        stderr (str): The standard error of the process.
+
+    Returns:
+        tuple: The cumulative import time (in microseconds) of every module imported, and the names of the top-level
+               imports among them, i.e. the modules imported directly by the script or by the interpreter startup.
+    """
+    modules = {}
+    top_level = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # The name is preceded by one space, plus two per nesting level
+        modules[name.strip()] = int(cumulative)
+        if not name.startswith('  '):
+            top_level.add(name.strip())
+    return modules, top_level
+
+
+def run_once(args):
+    """
+    Launches one CLI query and returns its wall time (in seconds), the import times of its modules and the names of
+    its top-level imports.
+    """
+    command = [sys.executable, '-X', 'importtime', '-m', 'app.main', '--label', args.label, '--n', '1']
+    if args.dir_csv is not None:
+        command += ['--dir_csv', args.dir_csv]
+    started = time.perf_counter()
+    process = subprocess.run(command, cwd=PROJECT_DIR, capture_output=True, text=True, check=True)
+    return (time.perf_counter() - started,) + parse_importtime(process.stderr)
+
+
+def main(args):
+    if args.compile:
+        command = [sys.executable, '-m', 'app.main', '--compile']
+        if args.dir_csv is not None:
+            command += ['--dir_csv', args.dir_csv]
+        subprocess.run(command, cwd=PROJECT_DIR, check=True, capture_output=True)
+
+    wall_times = []
+    import_times = {}
+    loaded = set()
+    for _ in range(args.runs):
+        wall_time, modules, top_level = run_once(args)
+        wall_times.append(wall_time)
+        loaded.update(modules)
+        for name in top_level:
+            import_times.setdefault(name, []).append(modules[name])
+
+    import_medians = {name: statistics.median(times) for name, times in import_times.items()}
+    heaviest = sorted(import_medians.items(), key=lambda item: item[1], reverse=True)[:args.top]
+    result = {'benchmark': 'cli_startup',
+              'python': sys.version.split()[0],
+              'runs': args.runs,
+              'wall_time_s': {'median': statistics.median(wall_times), 'min': min(wall_times), 'max': max(wall_times)},
+              'import_time_us': {'total': sum(import_medians.values()), 'heaviest': dict(heaviest)},
+              'heavy_modules_loaded': sorted(name for name in ('pandas', 'fastapi', 'pydantic', 'networkx')
+                                             if any(module.split('.')[0] == name for module in loaded))}
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CLI startup benchmark')
+    parser.add_argument('--label', default='CERVIX DISORDER', type=str, help='Name of the entity used for the query')
+    parser.add_argument('--dir_csv', default=None, type=str, help='Path to the csv file containing the ontology')
+    parser.add_argument('--runs', default=5, type=int, help='Number of processes launched')
+    parser.add_argument('--top', default=10, type=int, help='Number of top-level imports reported')
+    parser.add_argument('--compile', action='store_true', help='Compile the snapshot of the csv file before measuring')
+
+    main(parser.parse_args())
@@ -0,0 +1,147 @@
+"""
+Generates synthetic ontologies in the CSV format of Onto-X (`Class ID`, `Preferred Label`, `Parents`).
+
+The entities are laid out in levels: the roots have no parent, and each entity of a level has a primary parent in the
+level above, every parent having `branching` children on average. On top of this tree, a fraction of the entities get
+extra parents picked in any level above theirs (`multi_parent_ratio`), a fraction get one of their own children as an
+extra parent, which closes a cycle (`cycle_rate`), and a fraction share the label of another entity
+(`duplicate_ratio`), so that every step of `preprocess_dataframe` has work to do:
+
+    python benchmarks/synthetic.py --size 1000000 --depth 12 --branching 4 --output /tmp/onto_1m.csv
+"""
+import argparse
+import csv
+
+import numpy as np
+
+# Number of rows generated and written at a time, which bounds the memory used for ontologies of millions of entities
+CHUNK_SIZE = 500_000
+
+
+def level_sizes(size, depth, branching):
+    """
+    Splits the entities of an ontology into levels.
+
+    Args:
+        size (int): Number of entities.
+        depth (int): Number of levels, the roots being the first one.
+        branching (float): Average number of children of an entity.
+
+    Returns:
+        numpy.ndarray: The number of entities of each level, from the roots down, none of them being empty.
+    """
+    depth = max(min(depth, size), 1)
+    weights = branching ** np.arange(depth, dtype=np.float64)
+    ends = np.floor(size * np.cumsum(weights) / weights.sum()).astype(np.int64)
+    ends[-1] = size
+    sizes = np.empty(depth, dtype=np.int64)
+    previous_end = 0
+    for level, end in enumerate(ends):
+        end = min(max(int(end), previous_end + 1), size - (depth - 1 - level))
+        sizes[level] = end - previous_end
+        previous_end = end
+    return sizes
+
+
+def generate_parents(size, depth=8, branching=3.0, multi_parent_ratio=0.1, cycle_rate=0.001, seed=0):
+    """
+    Draws the parenthood relations of a synthetic ontology.
+
+    Args:
+        size (int): Number of entities.
+        depth (int, optional): Number of levels, defaults to 8.
+        branching (float, optional): Average number of children of an entity, defaults to 3.
+        multi_parent_ratio (float, optional): Fraction of the entities given an extra parent, defaults to 0.1.
+        cycle_rate (float, optional): Fraction of the entities given one of their children as an extra parent,
+                                      defaults to 0.001.
+        seed (int, optional): Seed of the random generator, defaults to 0.
+
+    Returns:
+        tuple: The codes of the children and of the parents of every relation (two numpy.ndarray of the same length),
+               and the level of each entity.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = level_sizes(size, depth, branching)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    level = np.repeat(np.arange(len(sizes)), sizes)
+
+    # Primary parents: the entities of a level are spread evenly over the entities of the level above
+    codes = np.arange(size, dtype=np.int64)
+    has_parent = level > 0
+    children = codes[has_parent]
+    child_level = level[has_parent]
+    position = (children - starts[child_level]) * sizes[child_level - 1] // sizes[child_level]
+    primary = starts[child_level - 1] + position
+    primary_of = np.full(size, -1, dtype=np.int64)
+    primary_of[children] = primary
+
+    # Extra parents, drawn uniformly among the entities of the levels above
+    extra = children[rng.random(len(children)) < multi_parent_ratio]
+    extra_parents = (rng.random(len(extra)) * starts[level[extra]]).astype(np.int64)
+
+    # Cycles: an entity becomes the parent of its own primary parent
+    cyclic = children[rng.random(len(children)) < cycle_rate]
+
+    sources = np.concatenate((children, extra, primary_of[cyclic]))
+    targets = np.concatenate((primary, extra_parents, cyclic))
+    keep = sources != targets
+    return sources[keep], targets[keep], level
+
+
+def write_ontology(path, size, depth=8, branching=3.0, multi_parent_ratio=0.1, cycle_rate=0.001, duplicate_ratio=0.01,
+                   seed=0):
+    """
+    Writes a synthetic ontology to a CSV file.
+
+    Args:
+        path (str): Path of the CSV file.
+        size (int): Number of entities.
+        depth (int, optional): Number of levels, defaults to 8.
+        branching (float, optional): Average number of children of an entity, defaults to 3.
+        multi_parent_ratio (float, optional): Fraction of the entities given an extra parent, defaults to 0.1.
+        cycle_rate (float, optional): Fraction of the entities closing a cycle, defaults to 0.001.
+        duplicate_ratio (float, optional): Fraction of the entities sharing the label of another one, defaults to 0.01.
+        seed (int, optional): Seed of the random generator, defaults to 0.
+
+    Returns:
+        dict: A description of the generated ontology (parameters, number of relations and levels).
+    """
+    sources, targets, level = generate_parents(size, depth, branching, multi_parent_ratio, cycle_rate, seed)
+    order = np.argsort(sources, kind='stable')
+    sources, targets = sources[order], targets[order]
+    bounds = np.searchsorted(sources, np.arange(size + 1))
+
+    rng = np.random.default_rng(seed + 1)
+    label_codes = np.arange(size)
+    duplicates = rng.random(size) < duplicate_ratio
+    label_codes[duplicates] = rng.integers(0, size, size=int(duplicates.sum()))
+
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Class ID', 'Preferred Label', 'Parents'])
+        for chunk_start in range(0, size, CHUNK_SIZE):
+            chunk_end = min(chunk_start + CHUNK_SIZE, size)
+            writer.writerows((f'http://synthetic/{code}',
+                              f'ENTITY {label_codes[code]}',
+                              '|'.join(f'http://synthetic/{parent}' for parent in targets[bounds[code]:bounds[code + 1]]))
+                             for code in range(chunk_start, chunk_end))
+
+    return {'size': size, 'depth': depth, 'branching': branching, 'multi_parent_ratio': multi_parent_ratio,
+            'cycle_rate': cycle_rate, 'duplicate_ratio': duplicate_ratio, 'seed': seed,
+            'relations': len(sources), 'levels': int(level.max()) + 1}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic ontology generator')
+    parser.add_argument('--output', required=True, type=str, help='Path of the CSV file written')
+    parser.add_argument('--size', default=10_000, type=int, help='Number of entities')
+    parser.add_argument('--depth', default=8, type=int, help='Number of levels of the hierarchy')
+    parser.add_argument('--branching', default=3.0, type=float, help='Average number of children of an entity')
+    parser.add_argument('--multi_parent_ratio', default=0.1, type=float, help='Fraction of the entities given an extra parent')
+    parser.add_argument('--cycle_rate', default=0.001, type=float, help='Fraction of the entities closing a cycle')
+    parser.add_argument('--duplicate_ratio', default=0.01, type=float, help='Fraction of the entities sharing the label of another one')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the random generator')
+
+    args = parser.parse_args()
+    print(write_ontology(args.output, args.size, args.depth, args.branching, args.multi_parent_ratio, args.cycle_rate,
+                         args.duplicate_ratio, args.seed))
@@ -2,12 +2,22 @@
 
 if [ "$1" = 'api' ]; then
     # Lancer le serveur FastAPI depuis le dossier `app`
-    uvicorn app.main:app --host 0.0.0.0 --port 8000
+    uvicorn app.api:app --host 0.0.0.0 --port 8000
+elif [ "$1" = 'workers' ]; then
+    # Compiler le snapshot une seule fois, puis lancer plusieurs workers qui se partagent ses pages en mémoire
+    # (un par cœur par défaut). Le rechargement et les diffs restent propres à chaque worker : pour mettre à jour
+    # l'ontologie, recompiler le snapshot et redémarrer les workers.
+    python -m app.main --compile ${ONTOLOGY_CLOSURE:+--closure "$ONTOLOGY_CLOSURE"} || exit 1
+    uvicorn app.api:app --host 0.0.0.0 --port 8000 --workers "${2:-$(nproc)}"
 elif [ "$1" = 'cli' ]; then
     shift
     # Exécuter le script en mode CLI
     python -m app.main "$@"
+elif [ "$1" = 'compile' ]; then
+    shift
+    # Compiler le CSV en snapshot binaire, chargé à la place du CSV tant qu'il est plus récent
+    python -m app.main --compile "$@"
 else
-    echo "Usage: api | cli [args]"
+    echo "Usage: api | workers [count] | cli [args] | compile [--dir_csv path] [--closure shortest|longest]"
     exit 1
 fi